@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+# Measures how fast ss_exporter exports a synthetic account served by a local
+# stand-in for the ScreenSteps API, so versions can be compared without a live
+# account. Every run is a fresh process that calls the exporter's main().
+
+import sys, getopt
+import os
+import json
+import time
+import random
+import re
+import shutil
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+api_host_pattern = re.compile(r'^https://[^/]+\.screenstepslive\.com/')
+
+# Define the help message here.
+def print_help():
+    print("""
+    Usage:
+    python ss_benchmark.py [options] [-- <exporter options>]
+
+    Explanations:
+    -e The ss_exporter.py to benchmark (optional). Defaults to the one next to this script.
+    -s Number of sites (optional). Defaults to 2.
+    -m Number of manuals in each site (optional). Defaults to 2.
+    -c Number of chapters in each manual (optional). Defaults to 5.
+    -a Number of articles in each chapter (optional). Defaults to 10.
+    -i Number of images in each article (optional). Defaults to 3. Every article also has one image shared by all articles and one attachment.
+    -k Kilobytes of html in each article body (optional). Defaults to 20.
+    -l Leave the articles out of the manual responses (optional), so the exporter lists each chapter's articles with a chapter request.
+    -L Milliseconds the server waits before answering each request (optional). Defaults to 0.
+    -T Fraction of API requests answered with a 429 (optional). Defaults to 0.
+    -w The retry_in seconds sent with each 429 (optional). Defaults to 1.
+    -n Number of runs (optional). Defaults to 1.
+    -O Write the results to this JSON file (optional).
+    Anything after -- is passed to the exporter, for example -- -t samples/json_backup -j 8.
+
+    Examples:
+    python ss_benchmark.py -s 4 -a 20 -- -t samples/json_backup -j 8
+    python ss_benchmark.py -L 50 -T 0.01 -n 3 -O before.json -- -t samples/manual_w_images_folder -j 16
+    """)
+
+class SyntheticAccount:
+    # Ids are handed out in order, so the site, manual and chapter of any id
+    # can be worked out without keeping the account in memory.
+    def __init__(self, sites, manuals, chapters, articles, images, html_kilobytes, embed_articles=True):
+        self.sites = sites
+        self.manuals = manuals
+        self.chapters = chapters
+        self.articles = articles
+        self.images = images
+        self.embed_articles = embed_articles # list each chapter's articles in its manual
+        self.filler = ('<p>' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 16 + '</p>') * max(1, html_kilobytes)
+
+    def article_count(self):
+        return self.sites * self.manuals * self.chapters * self.articles
+
+    def site(self, site_id):
+        first = (site_id - 1) * self.manuals + 1
+        return {'site': {'id': site_id, 'title': 'Site %d' % site_id, 'manuals': [
+            {'id': manual_id, 'title': 'Manual %d' % manual_id} for manual_id in range(first, first + self.manuals)]}}
+
+    def chapter_articles(self, chapter_id):
+        first = (chapter_id - 1) * self.articles + 1
+        return [{'id': article_id, 'title': 'Article %d' % article_id, 'last_edited_at': '2024-01-01T00:00:00Z'}
+            for article_id in range(first, first + self.articles)]
+
+    def manual(self, manual_id):
+        first = (manual_id - 1) * self.chapters + 1
+        chapters = []
+        for chapter_id in range(first, first + self.chapters):
+            chapter = {'id': chapter_id, 'title': 'Chapter %d' % chapter_id}
+            if self.embed_articles:
+                chapter['articles'] = self.chapter_articles(chapter_id)
+            chapters.append(chapter)
+        return {'manual': {'id': manual_id, 'title': 'Manual %d' % manual_id, 'chapters': chapters}}
+
+    def chapter(self, chapter_id):
+        return {'chapter': {'id': chapter_id, 'title': 'Chapter %d' % chapter_id, 'articles': self.chapter_articles(chapter_id)}}
+
+    def article(self, article_id, media_url):
+        chapter_id = (article_id - 1) // self.articles + 1
+        manual_id = (chapter_id - 1) // self.chapters + 1
+        blocks = []
+        html = self.filler
+        urls = [media_url + '%d/original/image_%d.png?sig=%d' % (article_id, index, article_id) for index in range(self.images)]
+        urls.append(media_url + 'shared/original/logo.png')
+        for url in urls:
+            blocks.append({'type': 'ImageContent', 'url': url})
+            html += '<img src="%s">' % url.split('?')[0]
+        url = media_url + '%d/original/handout.pdf' % article_id
+        blocks.append({'type': 'AttachmentContent', 'url': url})
+        html += '<a href="%s">Handout</a>' % url
+        blocks.append({'type': 'TextContent'})
+        return {'article': {
+            'id': article_id,
+            'title': 'Article %d' % article_id,
+            'manual_id': manual_id,
+            'chapter_id': chapter_id,
+            'last_edited_by': 'Benchmark',
+            'last_edited_at': '2024-01-01T00:00:00Z',
+            'meta_title': 'Article %d' % article_id,
+            'meta_description': 'Synthetic article %d' % article_id,
+            'meta_search': 'benchmark',
+            'created_at': '2023-01-01T00:00:00Z',
+            'html_body': html,
+            'content_blocks': blocks}}
+
+    def media(self, path):
+        # a few KB of bytes that differ per file
+        return (path.encode('utf-8') + b'\0') * 200
+
+class MockServer:
+    # Serves the api/v2 endpoints the exporter calls, plus the media files,
+    # from a SyntheticAccount on a local port.
+    def __init__(self, account, latency=0.0, throttle=0.0, retry_in=1.0):
+        self.account = account
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_in = retry_in
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.failing = {} # request path -> status to answer it with instead
+        self.reset()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {'api_requests': 0, 'media_requests': 0, 'throttled': 0, 'bytes': 0}
+
+    def count(self, name, body):
+        with self.lock:
+            self.counts[name] += 1
+            self.counts['bytes'] += len(body)
+
+    def respond(self, path):
+        # returns status, content type and body for a request path
+        if path in self.failing:
+            return self.failing[path], 'application/json', b'{}', 'media_requests' if path.startswith('/media/') else 'api_requests'
+        if path.startswith('/media/'):
+            return 200, 'application/octet-stream', self.account.media(path), 'media_requests'
+        with self.lock:
+            throttled = self.random.random() < self.throttle
+        if throttled:
+            with self.lock:
+                self.counts['throttled'] += 1
+            return 429, 'application/json', json.dumps({'retry_in': self.retry_in}).encode('utf-8'), 'api_requests'
+        endpoint = path[len('/api/v2/'):] if path.startswith('/api/v2/') else None
+        body = None
+        if endpoint == 'sites':
+            body = {'sites': [{'id': site_id, 'title': 'Site %d' % site_id} for site_id in range(1, self.account.sites + 1)]}
+        elif endpoint is not None:
+            match = re.match(r'sites/(\d+)(?:/(manuals|chapters|articles)/(\d+))?$', endpoint)
+            if match and match.group(2) is None:
+                body = self.account.site(int(match.group(1)))
+            elif match and match.group(2) == 'manuals':
+                body = self.account.manual(int(match.group(3)))
+            elif match and match.group(2) == 'chapters':
+                body = self.account.chapter(int(match.group(3)))
+            elif match:
+                body = self.account.article(int(match.group(3)), self.url + 'media/')
+        if body is None:
+            return 404, 'application/json', b'{}', 'api_requests'
+        return 200, 'application/json', json.dumps(body).encode('utf-8'), 'api_requests'
+
+    def handler(self):
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.answer(True)
+
+            def do_HEAD(self):
+                # the headers a GET would get, without the body
+                self.answer(False)
+
+            def answer(self, with_body):
+                if server.latency:
+                    time.sleep(server.latency)
+                status, content_type, body, counter = server.respond(self.path.split('?')[0])
+                server.count(counter, body if with_body else b'')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(body)
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def redirect_requests(server_url):
+    # send the exporter's API calls to the mock server instead of screenstepslive.com
+    import requests
+    original_request = requests.Session.request
+    def request(self, method, url, *args, **kwargs):
+        return original_request(self, method, api_host_pattern.sub(server_url, url), *args, **kwargs)
+    requests.Session.request = request
+
+def peak_rss():
+    # peak resident memory of this process and of its (worker) children, in bytes
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+def run_exporter(exporter_argv):
+    # runs in the child process started for each benchmark run
+    import ss_exporter
+    exit_code = 0
+    start = time.monotonic()
+    try:
+        ss_exporter.main(exporter_argv)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 1
+    elapsed = time.monotonic() - start
+    with open(os.environ['SS_BENCHMARK_RESULT'], 'w') as f:
+        json.dump({'seconds': elapsed, 'exit_code': exit_code, 'peak_rss': peak_rss()}, f)
+
+def benchmark(server, exporter, exporter_argv, run_number):
+    output_folder = tempfile.mkdtemp(prefix='ss_benchmark_')
+    result_path = os.path.join(output_folder, 'result.json')
+    environment = dict(os.environ,
+        SS_BENCHMARK_SERVER=server.url,
+        SS_BENCHMARK_EXPORTER=os.path.abspath(exporter),
+        SS_BENCHMARK_RESULT=result_path)
+    argv = [sys.executable, os.path.abspath(__file__), '-n', 'benchmark', '-u', 'benchmark', '-p', 'benchmark',
+        '-o', os.path.join(output_folder, 'output')] + exporter_argv
+    server.reset()
+    log_path = os.path.join(output_folder, 'exporter.log')
+    with open(log_path, 'w') as log:
+        subprocess.run(argv, env=environment, stdout=log, stderr=subprocess.STDOUT)
+    if not os.path.exists(result_path):
+        print("Error: The exporter didn't finish. See " + log_path)
+        sys.exit(2)
+    with open(result_path) as f:
+        result = json.load(f)
+    if result['exit_code'] != 0:
+        print("Error: The exporter exited with " + str(result['exit_code']) + ". See " + log_path)
+        sys.exit(2)
+    shutil.rmtree(output_folder)
+
+    seconds = result['seconds']
+    counts = dict(server.counts)
+    requests_made = counts['api_requests'] + counts['media_requests']
+    return {
+        'run': run_number,
+        'seconds': round(seconds, 3),
+        'articles': server.account.article_count(),
+        'articles_per_second': round(server.account.article_count() / seconds, 2),
+        'requests': requests_made,
+        'api_requests': counts['api_requests'],
+        'media_requests': counts['media_requests'],
+        'throttled': counts['throttled'],
+        'requests_per_second': round(requests_made / seconds, 2),
+        'bytes': counts['bytes'],
+        'bytes_per_second': round(counts['bytes'] / seconds),
+        'peak_rss': result['peak_rss']}
+
+def main(argv):
+    exporter = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ss_exporter.py')
+    sites = 2 #s
+    manuals = 2 #m
+    chapters = 5 #c
+    articles = 10 #a
+    images = 3 #i
+    html_kilobytes = 20 #k
+    embed_articles = True #l
+    latency = 0.0 #L
+    throttle = 0.0 #T
+    retry_in = 1.0 #w
+    runs = 1 #n
+    report_file = '' #O
+    try:
+        opts, exporter_argv = getopt.getopt(argv, "he:s:m:c:a:i:k:lL:T:w:n:O:")
+        for opt, arg in opts:
+            if opt == '-h':
+                print_help()
+                sys.exit()
+            elif opt == '-e':
+                exporter = arg
+            elif opt == '-s':
+                sites = int(arg)
+            elif opt == '-m':
+                manuals = int(arg)
+            elif opt == '-c':
+                chapters = int(arg)
+            elif opt == '-a':
+                articles = int(arg)
+            elif opt == '-i':
+                images = int(arg)
+            elif opt == '-k':
+                html_kilobytes = int(arg)
+            elif opt == '-l':
+                embed_articles = False
+            elif opt == '-L':
+                latency = float(arg) / 1000
+            elif opt == '-T':
+                throttle = float(arg)
+            elif opt == '-w':
+                retry_in = float(arg)
+            elif opt == '-n':
+                runs = max(1, int(arg))
+            elif opt == '-O':
+                report_file = arg
+    except (getopt.GetoptError, ValueError):
+        print('use "ss_benchmark.py -h" for help')
+        sys.exit(2)
+
+    if not os.path.exists(exporter):
+        print("Error: Exporter not found: " + exporter)
+        sys.exit(2)
+
+    account = SyntheticAccount(sites, manuals, chapters, articles, images, html_kilobytes, embed_articles)
+    server = MockServer(account, latency, throttle, retry_in)
+    print("Info: Serving " + str(account.article_count()) + " articles in " + str(sites) + " sites at " + server.url)
+
+    results = []
+    try:
+        for run_number in range(1, runs + 1):
+            result = benchmark(server, exporter, exporter_argv, run_number)
+            results.append(result)
+            print("Run %d: %.2fs, %.1f articles/s, %.1f requests/s, %.0f KB/s, %s throttled, peak RSS %s MB" % (
+                run_number, result['seconds'], result['articles_per_second'], result['requests_per_second'],
+                result['bytes_per_second'] / 1024.0, result['throttled'],
+                '%.1f' % (result['peak_rss'] / 1048576.0) if result['peak_rss'] is not None else 'n/a'))
+    finally:
+        server.close()
+
+    if report_file != '':
+        with open(report_file, 'w') as f:
+            json.dump({
+                'exporter': os.path.abspath(exporter),
+                'exporter_options': exporter_argv,
+                'account': {'sites': sites, 'manuals': manuals, 'chapters': chapters, 'articles': articles, 'images': images, 'html_kilobytes': html_kilobytes},
+                'server': {'latency': latency, 'throttle': throttle, 'retry_in': retry_in},
+                'runs': results}, f, sort_keys=True, indent=2, separators=(',', ': '))
+        print("Info: Results written to " + report_file)
+
+
+# In a benchmark run (and the worker processes it spawns with -P) this script
+# stands in for the exporter: requests go to the mock server and the exporter
+# is imported from the file being benchmarked.
+if os.environ.get('SS_BENCHMARK_SERVER'):
+    sys.path.insert(0, os.path.dirname(os.environ['SS_BENCHMARK_EXPORTER']))
+    redirect_requests(os.environ['SS_BENCHMARK_SERVER'])
+
+if __name__ == "__main__":
+    if os.environ.get('SS_BENCHMARK_RESULT'):
+        run_exporter(sys.argv[1:])
+    else:
+        main(sys.argv[1:])
@@ -8,13 +8,54 @@ import json
 import os, fnmatch
 import re
 import shutil
+import hashlib
+import itertools
+import html
+import gzip
+import io
+import tarfile
+import tempfile
+import zipfile
+import random
+import threading
+import queue
+import collections
+import contextlib
+import concurrent.futures
+import multiprocessing
 from urllib.parse import urlparse
+try:
+    import brotli # optional, for the .br files of -Z
+except ImportError:
+    brotli = None
 
 # globals
 article_file_indicator = '@article.*'
 manual_file_indicator = '@toc.*'
 image_folder_indicator = '@images'
 attach_folder_indicator = '@attachments'
+manifest_file_name = '.ss_manifest.json'
+media_store_folder = '.ss_media'
+media_index_file_name = 'index.jsonl'
+precompressed_folder_name = 'precompressed'
+media_chunk_size = 1024 * 1024
+journal_file_name = '.ss_journal'
+folder_lock_count = 64
+shard_file_name = '.ss_shard.json'
+report_file_name = 'ss_exporter_report.json'
+prometheus_file_name = 'ss_exporter.prom'
+archive_extensions = [('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar', 'tar'), ('.zip', 'zip')]
+
+# how requests that fail are handled, see Requester and CircuitBreaker
+connect_timeout = 10.0
+read_timeout = 60.0
+request_retries = 5
+retry_backoff = 1.0 # longest wait before the first retry, doubled for each one after
+max_retry_backoff = 30.0
+breaker_threshold = 5 # failures in a row before requests to a host are paused
+breaker_cooldown = 10.0 # first pause, doubled each time the host still fails after it
+max_breaker_cooldown = 120.0
+min_rate_fraction = 0.25 # of -r, the lowest the scheduler's rate is lowered to by 429s
 
 # these are the handlebars you can use in an article file
 article_handlebars = [
@@ -34,6 +75,8 @@ article_handlebars = [
 # {{chapter}} to start and end the chapter, then {{title}} in the block
 # {{article}} to start and end the manual, then {{title}} and {{link}} in the block
 
+handlebar_pattern = re.compile(r'{{(\w+)}}')
+
 # Define the help message here.
 def print_help():
     print("""
@@ -46,53 +89,738 @@ def print_help():
     [-a <article_id>]
     [-M <manual_file_name]
     [-i object_identifier]
+    [-j jobs]
+    [-I]
+    [-r requests_per_second]
+    [-R]
+    [-c snapshot_folder]
+    [-l snapshot_folder]
+    [-P processes]
+    [-x report_folder]
+    [-v]
+    [-T seconds]
+    [-f]
+    [-S]
+    [-z shard/shards]
+    [-g shard_folders]
+    [-d plan_file]
+    [-H]
+    [-e plan_file]
+    [-Z]
+    [-C]
 
     Explanations:
     -n This is used for the name of the account (http://<account_name>.screenstepslive.com)
     -u Your user ID
     -p Your API token or password
     -t The folder with your templates (optional)
-    -o The folder you would like with outputs (optional)
-    -s If you'd like to only download one site, specify the ID here (optional)
-    -m If you'd like to only download one manual, specify the ID here (optional)
-    -a If you'd like to only download one article, specify the ID here (optional)
-    -M Pass in a specific name to use for the manual file. Must pass in the -m parameter.
+    -o The folder you would like with outputs (optional). If it ends in .zip, .tar, .tar.gz or .tgz the export is written straight into an archive there instead.
+    -s If you'd like to only download one site, specify the ID here (optional). Separate several IDs with commas.
+    -m If you'd like to only download one manual, specify the ID here (optional). Separate several IDs with commas.
+    -a If you'd like to only download one article, specify the ID here (optional). Separate several IDs with commas. With a single -s the articles are looked up directly instead of listing every chapter.
+    -M Pass in a specific name to use for the manual file. Must pass in the -m parameter with one manual.
     -i Specifies how the site, manual, and article files should be named. By default the "id" from ScreenSteps is used. You can set this to "title" or "title_id". "title_id" will use the name with " [ID]" appended to the end.
+    -j The number of articles to fetch and render at the same time. Defaults to 1. The article lists of the next -j chapters are fetched ahead.
+    -I Incremental export. Only articles edited since the last incremental run are downloaded and written again, and articles that were deleted are removed.
+    -r The most API requests to make per second. When the server says the rate limit was hit all requests pause, and the rate and number of requests in flight are lowered and then slowly raised again.
+    -R Resume an export that was interrupted. Articles, manuals and sites the earlier run with the same settings finished are not exported again.
+    -c Save every API response and media file of this export into a snapshot folder.
+    -l Export from a snapshot folder saved with -c instead of the server. -n, -u and -p aren't needed.
+    -P The number of processes that export manuals at the same time, each running -j jobs of its own. Defaults to 1. Can't be used with -c.
+    -x The folder to write the run report (ss_exporter_report.json) and Prometheus textfile (ss_exporter.prom) to (optional). Without it they aren't written.
+    -v Print a line for every chapter, article and media file. By default they're printed at most once a second.
+    -T How many seconds to wait for the server to answer a request before trying it again. Defaults to 60. Requests that time out, lose their connection or get a 5xx answer are tried up to 5 more times, waiting longer each time.
+    -f Skip articles that still can't be fetched after retrying instead of stopping the export. They're listed at the end and in the run report, and the exit status is 1.
+    -S Write a search index of each manual's articles (<manual>.search.json) next to its TOC.
+    -z Export one shard of the articles, like 2/5 for the second of five. Each shard writes its articles and media to its own output folder, without the TOCs.
+    -g Merge the output folders of every shard of an export into -o, writing the TOCs. Separate the folders with commas. Use the same -t, -i, -M and -S as the shards.
+    -d Plan the export instead of running it, writing the plan to a file. Only the sites, manuals, chapters and articles are fetched, and what an export would take is printed: how many of each, the API requests and media files, and how long it would take.
+    -H With -d, ask the server for the size of every media file with a HEAD request.
+    -e Run the export planned with -d. The settings saved in the plan are used for anything not given, and the sites, manuals and chapters aren't fetched again.
+    -Z Write a .gz file (and a .br file, if the brotli package is installed) next to every HTML, JSON, CSS, JS, SVG and other text file, for web servers that serve precompressed files.
+    -C Write {{json}} compactly instead of pretty printed.
 
     Examples:
     run -n customerknowledge -u mikey -p mypassword -s 15226
     run -n myaccount -u johnsmith -p notAgoodPassword -a 21234
     """)
 
+class ExportError(Exception):
+    # resumable is set when an export stopped part way, so running it again
+    # with resume carries on from there
+    def __init__(self, message, resumable=False):
+        Exception.__init__(self, message)
+        self.resumable = resumable
+
+def split_ids(ids):
+    # "1, 2,3" -> ['1', '2', '3']
+    return [this_id.strip() for this_id in ids.split(',') if this_id.strip() != '']
+
+def selected(ids, this_id):
+    # nothing selected means everything is
+    return len(ids) == 0 or this_id in ids
+
 def make_dir(directory):
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-def download_file(directory, url):
-    short_path = url.split('/')[-1].split('?')[0]
-    local_filename = os.path.join(directory, short_path)
-    r = requests.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-    return short_path
-
-def find_file(pattern, path):
-    result = []
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            if fnmatch.fnmatch(name, pattern):
-                result.append(os.path.join(root, name))
-    return result
+    os.makedirs(directory, exist_ok=True)
+
+def new_session(jobs, session=None):
+    # one keep-alive connection per worker so concurrent requests don't queue for a socket
+    session = session or requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# The counters and timers of a run. Each value is kept by name and an optional
+# label, a (name, value) pair like ('endpoint', 'article'). Worker processes
+# take() theirs after each unit of work and the parent merge()s them in.
+metric_help = {
+    'api_requests_total': 'API requests made, including rate limited ones.',
+    'api_rate_limited_total': 'API requests answered with 429.',
+    'api_response_bytes_total': 'Bytes of API responses received.',
+    'api_request_seconds_total': 'Time spent on API requests.',
+    'api_requests_saved_total': 'API requests not made because the manual already listed the chapter\'s articles, or the plan run with -e had the response.',
+    'requests_retried_total': 'API requests and media downloads tried again, by why they failed.',
+    'circuit_breaker_opened_total': 'Times requests to a failing host were paused.',
+    'circuit_breaker_wait_seconds_total': 'Time requests spent waiting for a failing host to be tried again.',
+    'articles_failed_total': 'Articles skipped because they could not be exported.',
+    'media_revalidated_total': 'Media files the server said were unchanged since an earlier run downloaded them.',
+    'media_resumed_total': 'Media downloads carried on from where a failed try stopped.',
+    'rate_limit_wait_seconds_total': 'Time workers spent waiting on the rate limit before a request.',
+    'rate_limit_paused_seconds_total': 'Wall clock time the export was paused by 429 responses.',
+    'media_downloads_total': 'Media files downloaded.',
+    'media_downloaded_bytes_total': 'Bytes of media downloaded.',
+    'media_download_seconds_total': 'Time spent downloading media.',
+    'media_placed_total': 'Media files linked or copied into the export.',
+    'articles_exported_total': 'Articles fetched and written.',
+    'articles_skipped_total': 'Articles reused from an earlier run.',
+    'article_links_rewritten_total': 'Links to other articles pointed at their exported files, when rendering or once their targets were exported.',
+    'render_seconds_total': 'Time spent rendering each template.',
+    'renders_total': 'Times each template was rendered.',
+    'filesystem_write_seconds_total': 'Time spent writing files, by what was written.',
+    'precompressed_files_total': 'Compressed files written next to text files with -Z, by encoding.',
+    'phase_seconds_total': 'Time spent in each phase of the export, added up over processes.'}
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, value=1, label=None):
+        with self.lock:
+            self.values[(name, label)] = self.values.get((name, label), 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name, label=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, label)
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (this_name, label), value in self.values.items() if this_name == name)
+
+    def take(self):
+        with self.lock:
+            values = list(self.values.items())
+            self.values = {}
+        return values
+
+    def merge(self, values):
+        for (name, label), value in values:
+            self.add(name, value, label)
+
+    def items(self):
+        with self.lock:
+            return sorted(self.values.items(), key=lambda item: (item[0][0], item[0][1] or ('', '')))
+
+def metric_label(label):
+    if label is None:
+        return ''
+    return label[0] + '="' + _decode(label[1]).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+class ProgressLog:
+    # Prints the events of an export on the command line. Unless verbose, at
+    # most one chapter, article or media line is printed every interval
+    # seconds, with a count of the ones skipped.
+    def __init__(self, verbose, interval=1.0):
+        self.verbose = verbose
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = 0.0
+        self.skipped = 0
+
+    def __call__(self, event):
+        message = event['message']
+        if event['type'] in ('chapter', 'article', 'media'):
+            with self.lock:
+                now = time.monotonic()
+                if not self.verbose and now - self.last < self.interval:
+                    self.skipped += 1
+                    return
+                if self.skipped > 0:
+                    message += " (and " + _decode(self.skipped) + " more)"
+                self.last = now
+                self.skipped = 0
+        print(message)
+
+def run_now(fn, *args):
+    # stand-in for executor.submit when running with a single job
+    future = concurrent.futures.Future()
+    future.set_result(fn(*args))
+    return future
+
+class Journal:
+    # An append-only log of the articles, manuals and sites an export has
+    # finished, one JSON record per line, each flushed to disk before moving
+    # on. With --resume the log of an interrupted run with the same settings is
+    # read back so finished work is skipped. It's removed once a run completes.
+    # Worker processes attach to the journal their parent opened and append to it.
+    def __init__(self, path, signature, resume, attach=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.articles = {} # (site id, article id) -> manifest entry
+        self.manuals = {} # (site id, manual id) -> record
+        self.sites = {} # site id -> record
+        self.resumed = resume and self.load(signature)
+        if attach:
+            self.file = open(path, 'ab', buffering=0)
+            return
+        if not self.resumed:
+            open(path, 'wb').close()
+        # always appended to, so records from worker processes aren't overwritten
+        self.file = open(path, 'ab', buffering=0)
+        if not self.resumed:
+            self.record({'type': 'run', 'signature': signature})
+
+    def load(self, signature):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        for index, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break # the run stopped part way through writing this record
+            if index == 0:
+                if record.get('type') != 'run' or record.get('signature') != signature:
+                    return False
+            elif record['type'] == 'article':
+                record['entry']['manual'] = record['manual']
+                self.articles[(record['site'], _decode(record['entry']['id']))] = record['entry']
+            elif record['type'] == 'manual':
+                self.manuals[(record['site'], record['manual'])] = record
+            elif record['type'] == 'site':
+                self.sites[record['site']] = record
+        return len(lines) > 0
+
+    def record(self, record):
+        # one unbuffered write per record, so processes appending at the same
+        # time never interleave their lines. What the record is about is on
+        # disk first
+        sync_written_folders()
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self.lock:
+            self.file.write(line)
+            os.fsync(self.file.fileno())
+
+    def close(self, finished):
+        self.file.close()
+        if finished:
+            os.remove(self.path)
+
+class Snapshot:
+    # Everything an export downloaded, so templates can be rendered again
+    # later without touching the network. api.jsonl.gz holds one
+    # {"endpoint", "body"} record per API response, media/ holds the media
+    # files named by their sha256 and media.jsonl maps each url to one.
+    # mode is 'capture' or 'replay'.
+    def __init__(self, folder, mode, append=False):
+        self.folder = folder
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.media_folder = os.path.join(folder, 'media')
+        if mode == 'capture':
+            make_dir(self.media_folder)
+            self.api_file = gzip.open(os.path.join(folder, 'api.jsonl.gz'), 'at' if append else 'wt', encoding='utf-8')
+            self.media_file = open(os.path.join(folder, 'media.jsonl'), 'a' if append else 'w')
+        else:
+            self.responses = dict((r['endpoint'], r['body']) for r in self.read(gzip.open(os.path.join(folder, 'api.jsonl.gz'), 'rt', encoding='utf-8')))
+            self.media = dict((r['url'], r['sha256']) for r in self.read(open(os.path.join(folder, 'media.jsonl'))))
+
+    def read(self, f):
+        records = []
+        with f:
+            try:
+                for line in f:
+                    records.append(json.loads(line))
+            except (ValueError, EOFError, OSError):
+                pass # the capture stopped part way through writing this record
+        return records
+
+    def save_response(self, endpoint, body):
+        with self.lock:
+            self.api_file.write(json.dumps({'endpoint': endpoint, 'body': body}) + '\n')
+
+    def response(self, endpoint):
+        if endpoint not in self.responses:
+            raise ExportError("Error: " + endpoint + " isn't in the snapshot. Capture it again with this selection.")
+        return self.responses[endpoint]
+
+    def save_media(self, url, stored_path):
+        sha256 = os.path.basename(stored_path)
+        snapshot_path = os.path.join(self.media_folder, sha256)
+        with self.lock:
+            if not os.path.exists(snapshot_path):
+                link_file(stored_path, snapshot_path)
+            self.media_file.write(json.dumps({'url': url, 'sha256': sha256}) + '\n')
+
+    def media_path(self, url):
+        if url not in self.media:
+            raise ExportError("Error: " + url + " isn't in the snapshot. Capture it again with this selection.")
+        return os.path.join(self.media_folder, self.media[url])
+
+    def close(self):
+        if self.mode == 'capture':
+            self.api_file.close()
+            self.media_file.close()
+
+def retry_in(response):
+    # how long a 429 response asked us to wait
+    try:
+        return float(response.json().get('retry_in', 60)) # Default to 60 seconds if not provided
+    except ValueError:
+        return 60.0
+
+class RequestScheduler:
+    # Every API call asks the scheduler for a slot first. It keeps a token
+    # bucket (when a rate is given), pauses all workers together when the
+    # server answers 429 and honors its retry_in, and raises or lowers how
+    # many requests may be in flight at once (additive increase,
+    # multiplicative decrease) depending on how often that happens.
+    def __init__(self, max_concurrency, rate=None, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        # nothing is added while everyone is paused
+        if self.rate is not None and now >= self.paused_until:
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - max(self.last_refill, self.paused_until)) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        with self.condition:
+            throttled_wait = 0.0
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is not None and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                elif self.in_flight >= int(self.concurrency):
+                    self.condition.wait()
+                    continue
+                else:
+                    break
+                self.condition.wait(wait)
+                throttled_wait += time.monotonic() - now
+            if self.rate is not None:
+                self.tokens -= 1
+            self.in_flight += 1
+        if throttled_wait > 0:
+            self.metrics.add('rate_limit_wait_seconds_total', throttled_wait)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            if self.rate is not None:
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+            self.condition.notify_all()
+
+    def throttle(self, seconds):
+        # returns True for the 429 that started the pause, so only it gets reported
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            new_pause = now >= self.paused_until
+            if new_pause:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if self.rate is not None:
+                    self.rate = max(self.max_rate * min_rate_fraction, self.rate / 2)
+                paused = seconds
+            else:
+                paused = max(0.0, now + seconds - self.paused_until)
+            self.metrics.add('rate_limit_paused_seconds_total', paused)
+            self.paused_until = max(self.paused_until, now + seconds)
+            # the server's retry_in is the pause. One request goes as soon as
+            # it's over, the rest follow at the lowered rate
+            self.tokens = 1.0
+            self.condition.notify_all()
+            return new_pause
+
+class CircuitBreaker:
+    # Counts the requests to one host that failed in a row. Once there are
+    # threshold of them the circuit opens and requests to the host wait until
+    # cooldown seconds have passed. Then a single request is let through to
+    # try it again. If that works the circuit closes, if not it opens again for
+    # twice as long, up to max_cooldown.
+    def __init__(self, threshold=breaker_threshold, cooldown=breaker_cooldown, max_cooldown=max_breaker_cooldown):
+        self.threshold = threshold
+        self.first_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.condition = threading.Condition()
+        self.failures = 0
+        self.open_until = 0.0
+        self.trying = False
+
+    def wait(self):
+        # returns how long the request waited
+        start = time.monotonic()
+        with self.condition:
+            while self.failures >= self.threshold:
+                now = time.monotonic()
+                if now < self.open_until:
+                    self.condition.wait(self.open_until - now)
+                elif not self.trying:
+                    self.trying = True # this request tries the host again
+                    break
+                else:
+                    self.condition.wait()
+        return time.monotonic() - start
+
+    def succeeded(self):
+        with self.condition:
+            self.failures = 0
+            self.trying = False
+            self.cooldown = self.first_cooldown
+            self.condition.notify_all()
+
+    def failed(self):
+        # returns how long the circuit opened for, or 0 if it didn't
+        with self.condition:
+            self.failures += 1
+            tried = self.trying
+            self.trying = False
+            if tried:
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            elif self.failures != self.threshold:
+                return 0
+            self.open_until = time.monotonic() + self.cooldown
+            self.condition.notify_all()
+            return self.cooldown
+
+class IncompleteDownload(requests.exceptions.RequestException):
+    # a download that ended early or didn't match its checksum. It's tried
+    # again like a dropped connection
+    pass
+
+class Requester:
+    # Every request to the server goes through here, API calls and media
+    # downloads alike. Each has a connect and a read timeout. Timeouts,
+    # dropped connections and 5xx answers are tried again after an exponential
+    # backoff with full jitter, and each host has a CircuitBreaker so one that
+    # keeps failing gets a rest instead of a stream of retries. A 429 from the
+    # API pauses every worker through the scheduler instead.
+    def __init__(self, session, metrics=None, emit=None, timeout=read_timeout, retries=request_retries):
+        self.session = session
+        self.metrics = metrics or Metrics()
+        self.emit = emit or (lambda event_type, message, **fields: None)
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.breakers = {} # host -> CircuitBreaker
+        self.lock = threading.Lock()
+
+    def breaker(self, host):
+        with self.lock:
+            return self.breakers.setdefault(host, CircuitBreaker())
+
+    # returns read(response) for the first response with an ok status.
+    # observe(response, seconds) is called for every response, and headers()
+    # before every try. Anything else raises ExportError once it's not worth
+    # trying again.
+    def get(self, url, read, auth=None, stream=False, scheduler=None, observe=None, headers=None, ok=(200,), method='GET'):
+        host = urlparse(url).netloc
+        breaker = self.breaker(host)
+        attempt = 0
+        while True:
+            waited = breaker.wait()
+            if waited > 0:
+                self.metrics.add('circuit_breaker_wait_seconds_total', waited)
+            if scheduler is not None:
+                scheduler.acquire()
+            start = time.perf_counter()
+            r = None
+            error = None
+            try:
+                r = self.session.request(method, url, auth=auth, stream=stream, timeout=self.timeout, headers=headers() if headers is not None else None)
+                if observe is not None:
+                    observe(r, time.perf_counter() - start)
+                if r.status_code in ok:
+                    result = read(r)
+            except requests.exceptions.RequestException as e:
+                error = e
+            except BaseException:
+                # not the server's doing
+                if scheduler is not None:
+                    scheduler.release()
+                breaker.succeeded()
+                raise
+            finally:
+                if r is not None:
+                    r.close()
+
+            if error is None and r.status_code == 429 and scheduler is not None:
+                # Rate limit exceeded, every worker waits it out together
+                breaker.succeeded()
+                wait = retry_in(r)
+                if scheduler.throttle(wait):
+                    self.emit('rate_limited', f"Rate limit exceeded. Retrying in {wait:g} seconds...", seconds=wait)
+                continue
+            if scheduler is not None:
+                scheduler.release()
+
+            if error is None and r.status_code in ok:
+                breaker.succeeded()
+                return result
+            if error is None and r.status_code < 500 and r.status_code != 429:
+                # the server is fine, it just won't give us this
+                breaker.succeeded()
+                raise ExportError('Error connecting to server (' + _decode(r.status_code) + '): ' + url)
+
+            if isinstance(error, requests.exceptions.Timeout):
+                reason = 'timeout'
+            elif isinstance(error, (IncompleteDownload, requests.exceptions.ChunkedEncodingError)):
+                reason = 'incomplete'
+            elif error is not None:
+                reason = 'connection'
+            else:
+                reason = 'status_' + _decode(r.status_code)
+            cooldown = breaker.failed()
+            if cooldown > 0:
+                self.metrics.add('circuit_breaker_opened_total')
+                self.emit('warning', "Warn: Requests to " + host + " keep failing. Pausing them for " + _decode(round(cooldown, 1)) + " seconds.", host=host, seconds=cooldown)
+            attempt += 1
+            if attempt > self.retries:
+                if error is not None:
+                    raise ExportError("Error connecting to server: " + _decode(error))
+                raise ExportError('Error connecting to server (' + _decode(r.status_code) + '): ' + url)
+            self.metrics.add('requests_retried_total', 1, ('reason', reason))
+            time.sleep(random.uniform(0, min(max_retry_backoff, retry_backoff * 2 ** (attempt - 1))))
+
+def media_file_name(url):
+    return url.split('/')[-1].split('?')[0]
+
+def link_file(from_path, to_path):
+    # hardlink a stored file into place, copying if the filesystem won't link.
+    # It's linked next to the target and renamed over it, so threads or
+    # processes placing the same file at once don't trip over each other.
+    temp_path = temp_path_for(to_path)
+    try:
+        os.link(from_path, temp_path)
+    except OSError:
+        shutil.copyfile(from_path, temp_path)
+    os.replace(temp_path, to_path)
+    if os.path.exists(temp_path):
+        # renaming does nothing when both names already link to the same file
+        os.remove(temp_path)
+
+def content_range(response):
+    # (first byte, whole size) of a 206 response, or None
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('Content-Range', ''))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)) if match.group(2) != '*' else None
+
+def etag_md5(response):
+    # S3 and most CDNs use the MD5 of a file uploaded in one part as its ETag
+    match = re.match(r'^"?([0-9a-f]{32})"?$', response.headers.get('ETag', ''))
+    return match.group(1) if match is not None else None
+
+class MediaStore:
+    # Every media url is downloaded once per run into a content addressed store
+    # (files named by their sha256) and hardlinked into each folder that uses
+    # it, so shared logos and attachments aren't downloaded or stored again for
+    # every article.
+    #
+    # Downloads are written in large blocks and checked against Content-Length
+    # and an MD5 ETag. One that fails part way is carried on with a Range
+    # request. With keep the store stays in the output folder between runs,
+    # along with an index of the ETag and Last-Modified of each url, so the
+    # next run asks the server whether a file changed before downloading it.
+    def __init__(self, store_folder, requester=None, snapshot=None, metrics=None, output=None, keep=False):
+        self.store_folder = store_folder
+        self.requester = requester or Requester(requests, metrics)
+        self.snapshot = snapshot
+        self.metrics = metrics or Metrics()
+        self.output = output or folder_output
+        self.keep = keep
+        self.stored = {} # url -> file in the store
+        self.url_locks = {}
+        self.lock = threading.Lock()
+        self.index = {} # url without its query -> record
+        self.index_file = None
+        if keep:
+            self.load_index()
+
+    def load_index(self):
+        make_dir(self.store_folder)
+        path = os.path.join(self.store_folder, media_index_file_name)
+        self.index = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f.read().splitlines():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break # the run stopped part way through writing this record
+                    self.index[record['url']] = record
+        # one unbuffered write per record, like the journal, so worker
+        # processes can append to it at the same time
+        self.index_file = open(path, 'ab', buffering=0)
+
+    def remember(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self.lock:
+            self.index[record['url']] = record
+            self.index_file.write(line)
+
+    def fetch(self, url):
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            if url not in self.stored:
+                self.stored[url] = self.download(url)
+            return self.stored[url]
+
+    def download(self, url):
+        if self.snapshot is not None and self.snapshot.mode == 'replay':
+            return self.snapshot.media_path(url)
+        make_dir(self.store_folder)
+        start = time.perf_counter()
+        known = self.index.get(url.split('?')[0])
+        if known is not None and not os.path.exists(os.path.join(self.store_folder, known['sha256'])):
+            known = None
+        temp_path = temp_path_for(os.path.join(self.store_folder, 'download'))
+        part = {'size': 0, 'received': 0, 'sha256': hashlib.sha256(), 'md5': hashlib.md5(), 'validator': None}
+
+        def headers():
+            if part['size'] > 0 and part['validator'] is not None:
+                # carry on from where the last try stopped, if it's the same file
+                self.metrics.add('media_resumed_total')
+                return {'Range': 'bytes=' + _decode(part['size']) + '-', 'If-Range': part['validator']}
+            if known is not None:
+                # only sent again if it changed since it was stored
+                return dict(h for h in [('If-None-Match', known.get('etag')), ('If-Modified-Since', known.get('last_modified'))] if h[1] is not None)
+            return {}
+
+        def save(r):
+            if r.status_code == 304:
+                return None
+            if r.status_code == 416:
+                part['size'] = 0
+                raise IncompleteDownload("Couldn't carry on downloading " + url)
+            content_encoding = r.headers.get('Content-Encoding', 'identity')
+            if r.status_code == 206:
+                resumed_at = content_range(r)
+                if resumed_at is None or resumed_at[0] != part['size']:
+                    # not the rest of what we have, so the next try starts over
+                    part['size'] = 0
+                    raise IncompleteDownload("Got the wrong part of " + url)
+                mode = 'ab'
+                expected = resumed_at[1]
+            else:
+                # the whole file, from the start
+                part.update(size=0, sha256=hashlib.sha256(), md5=hashlib.md5())
+                mode = 'wb'
+                expected = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+            if content_encoding != 'identity':
+                expected = None # the length is of the encoded body
+            part['validator'] = r.headers.get('ETag') or r.headers.get('Last-Modified')
+            with open(temp_path, mode, buffering=media_chunk_size) as f:
+                for chunk in r.iter_content(chunk_size=media_chunk_size):
+                    f.write(chunk)
+                    part['sha256'].update(chunk)
+                    part['md5'].update(chunk)
+                    part['size'] += len(chunk)
+                    part['received'] += len(chunk)
+            if expected is not None and part['size'] != expected:
+                raise IncompleteDownload("Downloaded " + _decode(part['size']) + " of " + _decode(expected) + " bytes of " + url)
+            md5 = etag_md5(r)
+            if md5 is not None and content_encoding == 'identity' and part['md5'].hexdigest() != md5:
+                part['size'] = 0
+                raise IncompleteDownload("Checksum mismatch for " + url)
+            return r
 
-def find_dirs(pattern, path):
-    result = []
-    for root, dirs, files in os.walk(path):
-        for dirname in dirs:
-            if pattern in dirname.split():
-                result.append(os.path.join(root, dirname))
-    return result
+        try:
+            r = self.requester.get(url, save, stream=True, headers=headers, ok=(200, 206, 304, 416))
+        except ExportError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if r is None:
+            stored_path = os.path.join(self.store_folder, known['sha256'])
+            self.metrics.add('media_revalidated_total')
+        else:
+            sha256 = part['sha256'].hexdigest()
+            stored_path = os.path.join(self.store_folder, sha256)
+            os.replace(temp_path, stored_path)
+            written_to(self.store_folder)
+            self.metrics.add('media_downloads_total')
+            if self.keep:
+                self.remember({'url': url.split('?')[0], 'sha256': sha256, 'size': part['size'], 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')})
+        self.metrics.add('media_downloaded_bytes_total', part['received'])
+        self.metrics.add('media_download_seconds_total', time.perf_counter() - start)
+        if self.snapshot is not None:
+            self.snapshot.save_media(url, stored_path)
+        return stored_path
+
+    def place(self, directory, url):
+        short_path = media_file_name(url)
+        stored_path = self.fetch(url)
+        with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'media')):
+            self.output.link_file(stored_path, os.path.join(directory, short_path))
+        self.metrics.add('media_placed_total')
+        return short_path
+
+    def close(self):
+        if not self.keep:
+            # placed files are links of their own, so the store can go
+            remove_directory(self.store_folder)
+            return
+        self.index_file.close()
+
+        # anything nothing in the output links to any more is removed, and the
+        # index (with what worker processes added) is written again with just
+        # what's left
+        self.load_index()
+        self.index_file.close()
+        records = []
+        for record in self.index.values():
+            stored_path = os.path.join(self.store_folder, record['sha256'])
+            if os.path.exists(stored_path) and os.stat(stored_path).st_nlink > 1:
+                records.append(record)
+        kept = set(record['sha256'] for record in records)
+        for name in os.listdir(self.store_folder):
+            path = os.path.join(self.store_folder, name)
+            if os.path.isdir(path):
+                remove_directory(path)
+            elif name != media_index_file_name and name not in kept:
+                os.remove(path)
+        write_file(self.store_folder, media_index_file_name, ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
 
 def split_path(path):
     allparts = []
@@ -123,37 +851,527 @@ def find_relative_path(thispath,template_folder):
         relative_path = ''
     return relative_path
 
-def find_at_file_path(thispath,template_folder):
-    relative_path = remove_list_overlap(split_path(thispath),split_path(template_folder))
-    return os.path.join(*relative_path)
-
 def remove_directory(directory):
     if os.path.exists(directory):
         shutil.rmtree(directory)
 
-def remove_directories(directories):
-    for directory in directories:
-        remove_directory(directory)
-
-def remove_found_files(files):
-    for name in files:
-        if os.path.exists(name):
-            os.remove(name)
+def temp_path_for(path):
+    # a sibling of path that no other thread or process will pick
+    return '%s.%d.%d.part' % (path, os.getpid(), threading.get_ident())
 
 def write_file(directory, name, rawtext):
-    with open(os.path.join(directory, name), 'wb+') as f:
-        f.write(rawtext.encode('utf-8'))
-
-def copy_and_overwrite(from_path, to_path):
-    if os.path.exists(to_path):
-        shutil.rmtree(to_path)
-    shutil.copytree(from_path, to_path)
+    write_data(directory, name, rawtext.encode('utf-8'))
+
+# the folders each thread renamed files into since the journal last recorded
+# its work. They're synced once each before the next record, instead of after
+# every file
+written_folders = threading.local()
+
+def written_to(directory):
+    if not hasattr(written_folders, 'folders'):
+        written_folders.folders = set()
+    written_folders.folders.add(directory or '.')
+
+def sync_written_folders():
+    # Windows can't open a folder
+    folders = getattr(written_folders, 'folders', set())
+    written_folders.folders = set()
+    if os.name != 'posix':
+        return
+    for directory in sorted(folders):
+        if os.path.isdir(directory):
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+def write_data(directory, name, data):
+    # written next to the real file and renamed into place, so a crash never
+    # leaves half a file behind
+    path = os.path.join(directory, name)
+    temp_path = temp_path_for(path)
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        written_to(directory)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def archive_format(path):
+    for extension, archive in archive_extensions:
+        if path.lower().endswith(extension):
+            return archive
+    return None
+
+class FolderOutput:
+    # Where the files of an export go. This writes them into the output
+    # folder; ArchiveOutput has the same methods and streams them into a zip
+    # or tar archive instead.
+    def make_dir(self, directory):
+        make_dir(directory)
+
+    def write_file(self, directory, name, rawtext):
+        write_file(directory, name, rawtext)
+
+    def write_data(self, directory, name, data, compress=True):
+        write_data(directory, name, data)
+
+    def copy_file(self, from_path, to_path):
+        shutil.copy2(from_path, to_path)
+
+    def link_file(self, from_path, to_path):
+        link_file(from_path, to_path)
+
+    def move_file(self, from_path, to_path):
+        os.replace(from_path, to_path)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+folder_output = FolderOutput()
+
+class ArchiveOutput:
+    # Streams an export into a zip, tar or tar.gz archive. Paths are given as
+    # they'd be in the output folder and stored relative to root, so the
+    # archive has the same layout. Folders are still made under root, which
+    # is a scratch folder, for the few files (like TOCs) that are put
+    # together on disk first. The archive is written to a temporary name and
+    # renamed into place once it's closed.
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.format = archive_format(path)
+        self.temp_path = temp_path_for(path)
+        self.lock = threading.Lock()
+        self.names = set()
+        if self.format == 'zip':
+            self.archive = zipfile.ZipFile(self.temp_path, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(self.temp_path, 'w:gz' if self.format == 'tar.gz' else 'w')
+
+    def add(self, path, data=None, source=None, compress=True):
+        # a file from data or from the source path, or a folder if neither is given
+        name = os.path.relpath(path, self.root).replace(os.sep, '/')
+        with self.lock:
+            # an archive can't replace an entry, so the first file written to a
+            # path wins (the output folder keeps the last)
+            if name in self.names:
+                return
+            self.names.add(name)
+            if self.format == 'zip':
+                if source is not None:
+                    self.archive.write(source, name, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+                elif data is None:
+                    self.archive.writestr(name + '/', b'')
+                else:
+                    info = zipfile.ZipInfo(name, time.localtime()[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+                    info.external_attr = 0o644 << 16
+                    self.archive.writestr(info, data)
+            elif source is not None:
+                self.archive.add(source, name, recursive=False)
+            else:
+                info = tarfile.TarInfo(name)
+                info.mtime = time.time()
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    self.archive.addfile(info)
+                else:
+                    info.mode = 0o644
+                    info.size = len(data)
+                    self.archive.addfile(info, io.BytesIO(data))
+
+    def make_dir(self, directory):
+        make_dir(directory)
+        if os.path.relpath(directory, self.root) != '.':
+            self.add(directory)
+
+    def write_file(self, directory, name, rawtext):
+        self.add(os.path.join(directory, name), data=rawtext.encode('utf-8'))
+
+    def write_data(self, directory, name, data, compress=True):
+        self.add(os.path.join(directory, name), data=data, compress=compress)
+
+    def copy_file(self, from_path, to_path):
+        self.add(to_path, source=from_path)
+
+    def link_file(self, from_path, to_path):
+        # media is mostly compressed already
+        self.add(to_path, source=from_path, compress=False)
+
+    def move_file(self, from_path, to_path):
+        self.add(to_path, source=from_path)
+        os.remove(from_path)
+
+    def close(self):
+        with self.lock:
+            self.archive.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        with self.lock:
+            self.archive.close()
+        os.remove(self.temp_path)
+
+# the text files -Z writes .gz and .br files of, rendered or not
+precompress_extensions = ('.html', '.htm', '.json', '.js', '.css', '.svg', '.txt', '.xml', '.csv', '.md')
+precompress_encodings = [('.gz', 'gzip'), ('.br', 'br')]
+
+def precompressed(data, extension):
+    # gzip with no timestamp, so the same file always compresses the same
+    if extension == '.gz':
+        return gzip.compress(data, 9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+class PrecompressedOutput:
+    # Wraps the output of an export and writes a .gz (and with the brotli
+    # package a .br) file next to every text file, for web servers that send
+    # precompressed files as they are (like nginx's gzip_static). Linked files
+    # (like media from the store) are compressed once per run into
+    # cache_folder, and linked into place from there.
+    def __init__(self, output, metrics, cache_folder):
+        self.output = output
+        self.metrics = metrics
+        self.cache_folder = cache_folder
+        self.encodings = [(extension, encoding) for extension, encoding in precompress_encodings if extension == '.gz' or brotli is not None]
+
+    def compressed(self, path):
+        return os.path.splitext(path)[1].lower() in precompress_extensions
+
+    def write_siblings(self, path, data):
+        for extension, encoding in self.encodings:
+            with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'precompress')):
+                self.output.write_data(os.path.dirname(path), os.path.basename(path) + extension, precompressed(data, extension), compress=False)
+            self.metrics.add('precompressed_files_total', 1, ('encoding', encoding))
+
+    def make_dir(self, directory):
+        self.output.make_dir(directory)
+
+    def write_file(self, directory, name, rawtext):
+        self.output.write_file(directory, name, rawtext)
+        if self.compressed(name):
+            self.write_siblings(os.path.join(directory, name), rawtext.encode('utf-8'))
+
+    def write_data(self, directory, name, data, compress=True):
+        self.output.write_data(directory, name, data, compress)
+
+    def copy_file(self, from_path, to_path):
+        self.output.copy_file(from_path, to_path)
+        if self.compressed(to_path):
+            with open(from_path, 'rb') as f:
+                self.write_siblings(to_path, f.read())
+
+    def link_file(self, from_path, to_path):
+        self.output.link_file(from_path, to_path)
+        if self.compressed(to_path):
+            # nothing is written next to from_path, which can be a replayed
+            # snapshot or a shard being merged
+            name = hashlib.sha256(os.path.abspath(from_path).encode('utf-8')).hexdigest()
+            for extension, encoding in self.encodings:
+                cached_path = os.path.join(self.cache_folder, name + extension)
+                if not os.path.exists(cached_path):
+                    make_dir(self.cache_folder)
+                    with open(from_path, 'rb') as f:
+                        write_data(self.cache_folder, name + extension, precompressed(f.read(), extension))
+                    self.metrics.add('precompressed_files_total', 1, ('encoding', encoding))
+                self.output.link_file(cached_path, to_path + extension)
+
+    def move_file(self, from_path, to_path):
+        if self.compressed(to_path):
+            with open(from_path, 'rb') as f:
+                self.write_siblings(to_path, f.read())
+        self.output.move_file(from_path, to_path)
+
+    def close(self):
+        self.output.close()
+
+    def abort(self):
+        self.output.abort()
+
+# The template folder is walked once up front. The plan lists the "@" files
+# and, separately for the site and for the @article folder, the directories
+# and plain files each export needs, so nothing has to be copied and then
+# cleaned up again. Plan paths are relative to the template or @article folder.
+def plan_template(template_folder):
+    layout = {
+        'template_folder': template_folder,
+        'article_folders': [],
+        'article_templates': [],
+        'toc_templates': [],
+        'images': [],
+        'attachments': [],
+        'dirs': [],
+        'files': []}
+    for root, dirs, files in os.walk(template_folder):
+        for dirname in dirs:
+            if "@article" in dirname.split():
+                layout['article_folders'].append(os.path.join(root, dirname))
+            layout['dirs'].append(os.path.relpath(os.path.join(root, dirname), template_folder))
+        for name in files:
+            path = os.path.join(root, name)
+            if fnmatch.fnmatch(name, article_file_indicator):
+                layout['article_templates'].append(path)
+            elif fnmatch.fnmatch(name, manual_file_indicator):
+                layout['toc_templates'].append(path)
+            elif fnmatch.fnmatch(name, image_folder_indicator):
+                layout['images'].append(os.path.relpath(root, template_folder))
+            elif fnmatch.fnmatch(name, attach_folder_indicator):
+                layout['attachments'].append(os.path.relpath(root, template_folder))
+            else:
+                layout['files'].append(os.path.relpath(path, template_folder))
+    return layout
+
+def split_layout(layout, article_folder):
+    # divide the plain directories and files between the site and the @article folder
+    article_relative = os.path.relpath(article_folder, layout['template_folder']) if article_folder else None
+    def in_article_folder(path):
+        return article_relative is not None and (path == article_relative or path.startswith(article_relative + os.sep))
+    layout['site_dirs'] = [d for d in layout['dirs'] if not in_article_folder(d)]
+    layout['site_files'] = [f for f in layout['files'] if not in_article_folder(f)]
+    layout['article_dirs'] = [os.path.relpath(d, article_relative) for d in layout['dirs'] if in_article_folder(d) and d != article_relative]
+    layout['article_files'] = [os.path.relpath(f, article_relative) for f in layout['files'] if in_article_folder(f)]
+    layout['article_folder'] = article_folder
+    return layout
+
+def lay_out_site(layout, site_folder, output=folder_output):
+    output.make_dir(site_folder)
+    for directory in layout['site_dirs']:
+        output.make_dir(os.path.join(site_folder, directory))
+    for path in layout['site_files']:
+        output.copy_file(os.path.join(layout['template_folder'], path), os.path.join(site_folder, path))
+
+def lay_out_article(layout, article_folder, output=folder_output):
+    remove_directory(article_folder)
+    output.make_dir(article_folder)
+    for directory in layout['article_dirs']:
+        output.make_dir(os.path.join(article_folder, directory))
+    for path in layout['article_files']:
+        output.copy_file(os.path.join(layout['article_folder'], path), os.path.join(article_folder, path))
 
 def read_file(path):
     with open(path) as f:
         contents = f.read()
     return contents
 
+# The manifest records what an incremental export wrote for each article so the
+# next run can skip articles whose last_edited_at hasn't changed. All paths in
+# it are relative to the site folder.
+def read_manifest(site_folder):
+    path = os.path.join(site_folder, manifest_file_name)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'signature': '', 'articles': {}, 'manuals': {}}
+
+def write_manifest(site_folder, manifest):
+    write_file(site_folder, manifest_file_name, json.dumps(manifest, sort_keys=True, indent=2, separators=(',', ': ')))
+
+def manifest_paths(entry):
+    return entry.get('files', []) + entry.get('media', []) + entry.get('folders', [])
+
+def files_exist(site_folder, entry):
+    return all(os.path.exists(os.path.join(site_folder, path)) for path in manifest_paths(entry))
+
+def is_current(site_folder, entry, last_edited_at):
+    if entry is None or last_edited_at is None or entry['last_edited_at'] != last_edited_at:
+        return False
+    return files_exist(site_folder, entry)
+
+def prune_manifest(site_folder, old_manifest, manifest):
+    # remove anything the old manifest wrote that the new one no longer points
+    # at. Returns the paths removed
+    removed = []
+    keep = set()
+    for entries in (manifest['articles'], manifest['manuals']):
+        for entry in entries.values():
+            keep.update(manifest_paths(entry))
+    for entries in (old_manifest['articles'], old_manifest['manuals']):
+        for entry in entries.values():
+            for path in manifest_paths(entry):
+                full_path = os.path.join(site_folder, path)
+                if path not in keep and os.path.exists(full_path):
+                    removed.append(path)
+                    if os.path.isdir(full_path):
+                        remove_directory(full_path)
+                    else:
+                        os.remove(full_path)
+                        for extension, encoding in precompress_encodings:
+                            if os.path.exists(full_path + extension):
+                                os.remove(full_path + extension)
+    return removed
+
+# Templates are split once into a token list where even entries are literal
+# text and odd entries are handlebar names, so rendering is a single join
+# instead of a str.replace pass per handlebar.
+def compile_template(text):
+    return handlebar_pattern.split(text)
+
+def template_handlebars(tokens):
+    return tokens[1::2]
+
+def iter_template(tokens, values):
+    for index, token in enumerate(tokens):
+        if index % 2 == 0:
+            yield token
+        elif token in values:
+            yield values[token]
+        else:
+            # leave handlebars we don't know about alone
+            yield '{{' + token + '}}'
+
+def render_template(tokens, values):
+    return ''.join(iter_template(tokens, values))
+
+def copy_bytes(source, target, count):
+    while count > 0:
+        chunk = source.read(min(count, 1024 * 1024))
+        if not chunk:
+            break
+        target.write(chunk)
+        count -= len(chunk)
+
+# stands in for {{json}} in a TOC until the whole manual is known
+json_placeholder = object()
+
+class TocWriter:
+    # Streams a TOC file to disk as each chapter is finished instead of holding
+    # the whole file in memory. {{json}} needs the whole manual, so where it
+    # goes is remembered and the JSON is spliced in when the file is closed.
+    def __init__(self, directory, name, output=folder_output):
+        self.path = os.path.join(directory, name)
+        self.output = output
+        self.temp_path = temp_path_for(self.path)
+        self.file = open(self.temp_path, 'wb')
+        self.json_offsets = []
+
+    def write_template(self, tokens, values):
+        values = dict(values)
+        values['json'] = json_placeholder
+        for piece in iter_template(tokens, values):
+            if piece is json_placeholder:
+                self.json_offsets.append(self.file.tell())
+            elif piece != '':
+                self.file.write(piece.encode('utf-8'))
+
+    def close(self, json_text=''):
+        end = self.file.tell()
+        if all(offset == end for offset in self.json_offsets):
+            # nothing to splice, the JSON (if any) just goes on the end
+            for offset in self.json_offsets:
+                self.file.write(json_text.encode('utf-8'))
+            self.file.close()
+        else:
+            self.file.close()
+            json_bytes = json_text.encode('utf-8')
+            with open(self.temp_path, 'rb') as source, open(self.temp_path + '.json', 'wb') as target:
+                position = 0
+                for offset in self.json_offsets:
+                    copy_bytes(source, target, offset - position)
+                    target.write(json_bytes)
+                    position = offset
+                shutil.copyfileobj(source, target)
+            os.replace(self.temp_path + '.json', self.temp_path)
+        self.output.move_file(self.temp_path, self.path)
+
+    def abort(self):
+        # drop the partly written file of a manual that didn't finish
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.temp_path)
+
+def compile_article_template(path, template_folder):
+    tokens = compile_template(read_file(path))
+    relative_path = find_relative_path(path, template_folder)
+    if relative_path != '':
+        back_dir = '../' * len(split_path(relative_path))
+    else:
+        back_dir = ''
+    return {
+        'tokens': tokens,
+        'relative_path': relative_path,
+        'extension': os.path.splitext(path)[1],
+        'back_dir': back_dir,
+        'uses_json': 'json' in template_handlebars(tokens)}
+
+# The search index of a manual maps every word in its articles to the
+# articles that use it, weighted by where the word appears.
+search_index_extension = '.search.json'
+search_field_weights = [('title', 10), ('meta_search', 5), ('meta_description', 3)]
+search_snippet_length = 160
+search_stop_words = set('a an and are as at be but by can do for from has have how if in into is it its not of on or so that the their then there these this to was were what when where which will with you your'.split())
+markup_pattern = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.S | re.I)
+word_pattern = re.compile(r'\w+')
+
+# links between articles are rewritten in the files of these types
+article_link_extensions = ('.html', '.htm')
+
+def article_link_pattern(site_name):
+    # links to an article on the live site, /a/<id> or /s/<site>/m/<manual>/l/<id>,
+    # with or without the title after the id
+    host = re.escape(site_name) if site_name != '' else r'[\w-]+'
+    return re.compile(r'https?://' + host + r'\.screenstepslive\.com/(?:a|s/\d+/m/\d+/l)/(\d+)(?:-[\w%-]*)?')
+
+def html_text(body):
+    # the words of an article body without its markup
+    return ' '.join(html.unescape(markup_pattern.sub(' ', body)).split())
+
+def search_document(fields, body):
+    # an article's weighted words and snippet. They're kept in its manifest
+    # entry, so an incremental run can index articles it didn't fetch again
+    text = html_text(body)
+    terms = {}
+    for name, weight in search_field_weights + [(None, 1)]:
+        value = text if name is None else html_text(_decode(fields.get(name) or ''))
+        for word in word_pattern.findall(value.lower()):
+            if len(word) > 1 and word not in search_stop_words:
+                terms[word] = terms.get(word, 0) + weight
+    snippet = html_text(_decode(fields.get('meta_description') or '')) or text
+    if len(snippet) > search_snippet_length:
+        snippet = snippet[:search_snippet_length].rsplit(' ', 1)[0] + '...'
+    return {'terms': terms, 'snippet': snippet}
+
+def build_search_index(manual, entries, site_folder, directory):
+    # articles are numbered in TOC order, and each word lists [article, weight]
+    # pairs, highest weight first. Links are relative to the index
+    articles = []
+    terms = {}
+    for entry in entries:
+        if 'search' not in entry:
+            continue
+        page = next((path for path in entry['files'] if path.endswith('.html')), entry['files'][0])
+        for word, weight in entry['search']['terms'].items():
+            terms.setdefault(word, []).append([len(articles), weight])
+        articles.append({
+            'id': entry['id'],
+            'title': entry['fields']['title'],
+            'link': os.path.relpath(os.path.join(site_folder, page), directory).replace("\\", "/"),
+            'snippet': entry['search']['snippet']})
+    for postings in terms.values():
+        postings.sort(key=lambda posting: -posting[1])
+    return {'manual': {'id': manual['id'], 'title': manual['title']}, 'articles': articles, 'terms': terms}
+
+def url_rewriter(rewrites):
+    # rewrites is a list of [url, replacement]. Returns a function that swaps
+    # every url for its replacement (with an optional prefix) in one pass over
+    # the text. The first replacement listed for a url wins.
+    lookup = {}
+    for url, replacement in rewrites:
+        lookup.setdefault(url, replacement)
+    if len(lookup) == 0:
+        return lambda text, prefix='': text
+    # longest first so a url never matches as the prefix of a longer one
+    pattern = re.compile('|'.join(re.escape(url) for url in sorted(lookup, key=len, reverse=True)))
+    def rewrite(text, prefix=''):
+        return pattern.sub(lambda match: prefix + lookup[match.group(0)], text)
+    return rewrite
+
 def _decode(var):
     # all strings are unicode now
     return str(var)
@@ -164,20 +1382,122 @@ def prepare_for_filename(string):
 def _print(var):
     return var
 
-def main(argv):
+class ExportConfig:
+    # The settings of one export, the same ones the command line options set.
+    # Anything not given keeps its default, e.g.
+    # ExportConfig(site_name='acme', user_id='me', api_token='...', output_folder='export.zip')
+    defaults = {
+        'site_name': '', #n / site_name
+        'user_id': '', #u / user_id
+        'api_token': '', #p / password
+        'template_folder': '', #t / template
+        'output_folder': '', #o / output
+        'site_id': '', #s / site
+        'manual_id': '', #m / manual
+        'article_id': '', #a / article
+        'manual_file_name': '', #M / manual_file_name
+        'object_identifier': 'id', #i / object_identifier
+        'jobs': 1, #j / jobs
+        'incremental': False, #I / incremental
+        'rate': None, #r / rate
+        'resume': False, #R / resume
+        'capture_folder': '', #c / capture
+        'replay_folder': '', #l / replay
+        'processes': 1, #P / processes
+        'report_folder': '', #x / report_folder
+        'verbose': False, #v / verbose
+        'timeout': read_timeout, #T / timeout
+        'skip_failed': False, #f / skip_failed
+        'search_index': False, #S / search_index
+        'shard': '', #z / shard
+        'merge': '', #g / merge
+        'plan': '', #d / plan
+        'head': False, #H / head
+        'execute': '', #e / execute
+        'precompress': False, #Z / precompress
+        'compact_json': False} #C / compact_json
+
+    def __init__(self, **settings):
+        for name in settings:
+            if name not in self.defaults:
+                raise ExportError("Error: Unknown export setting " + name + ".")
+        for name, value in self.defaults.items():
+            setattr(self, name, settings.get(name, value))
+
+    def settings(self):
+        return dict((name, getattr(self, name)) for name in self.defaults)
+
+    def validate(self):
+        # a plan's settings fill in anything that wasn't given
+        if self.execute != '':
+            if self.plan != '' or self.merge != '' or self.replay_folder != '':
+                raise ExportError("Error: -e can't be used with -d, -g or -l.")
+            if not os.path.exists(self.execute):
+                raise ExportError("Error: No plan found in " + self.execute + ".")
+            plan = json.loads(read_file(self.execute))
+            for name, value in plan['settings'].items():
+                if name in self.defaults and getattr(self, name) == self.defaults[name]:
+                    setattr(self, name, value)
+
+        if self.plan != '':
+            if self.merge != '' or self.resume or self.incremental or self.processes > 1:
+                raise ExportError("Error: -d can't be used with -g, -R, -I or -P.")
+        elif self.head:
+            raise ExportError("Error: -H can only be used with -d.")
+
+        # check if required attributes exist. a replay or merge doesn't talk to the server.
+        if self.merge != '':
+            if self.shard != '' or self.incremental or self.resume or self.capture_folder != '' or self.replay_folder != '' or self.processes > 1:
+                raise ExportError("Error: -g can't be used with -z, -I, -R, -c, -l or -P.")
+            for folder in split_ids(self.merge):
+                if not os.path.exists(os.path.join(folder, shard_file_name)):
+                    raise ExportError("Error: " + folder + " isn't the output of a finished -z shard.")
+        elif self.replay_folder != '':
+            if not os.path.exists(os.path.join(self.replay_folder, 'api.jsonl.gz')):
+                raise ExportError("Error: No snapshot found in " + self.replay_folder + ".")
+            if self.capture_folder != '':
+                raise ExportError("Error: -c and -l can't be used together.")
+        elif (self.site_name == '') or (self.user_id == '') or (self.api_token == ''):
+            raise ExportError("Site_name, user_id, and password are required.")
+
+        if self.jobs < 1 or self.processes < 1:
+            raise ExportError("Error: -j and -P must be at least 1.")
+
+        if self.rate is not None and self.rate <= 0:
+            raise ExportError("Error: -r must be a number of requests per second.")
+
+        if self.timeout <= 0:
+            raise ExportError("Error: -T must be a number of seconds.")
+
+        if self.capture_folder != '' and self.processes > 1:
+            raise ExportError("Error: -c and -P can't be used together.")
+
+        if self.manual_file_name != '' and len(split_ids(self.manual_id)) != 1:
+            raise ExportError("Error: -M can only be used with a single -m manual.")
+
+        parse_shard(self.shard)
+
+        # an archive is written from scratch each time, by one process
+        if archive_format(self.output_folder) is not None:
+            if self.shard != '':
+                raise ExportError("Error: -z can't be used when -o is an archive.")
+            if self.incremental or self.resume or self.processes > 1:
+                raise ExportError("Error: -I, -R and -P can't be used when -o is an archive.")
+
+def parse_shard(shard):
+    # "2/5" -> (2, 5), and (0, 0) when the export isn't sharded
+    if shard == '':
+        return 0, 0
+    match = re.match(r'^(\d+)/(\d+)$', shard.strip())
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ExportError("Error: -z must be a shard number and a count of shards, like 2/5.")
+    return int(match.group(1)), int(match.group(2))
+
+def parse_options(argv):
     # Define variables we need.
-    site_name = '' #n / site_name
-    user_id = ''#u / user_id
-    api_token = ''#p / password
-    template_folder = '' #t / template
-    output_folder = '' #o / output
-    site_id = ''#s / site
-    manual_id = ''#m / manual
-    article_id = ''#a / article
-    manual_file_name = ''#M / manual_file_name
-    object_identifier = 'id'#i / object_identifier
+    config = ExportConfig()
     try:
-        opts, args = getopt.getopt(argv,"hn:u:p:t:o:s:m:a:M:i:",["site_name=","user_id=","password=","template_folder=","output_folder=","site_id=","manual_id=","article_id=","manual_file_name=","object_identifier="])
+        opts, args = getopt.getopt(argv,"hn:u:p:t:o:s:m:a:M:i:j:Ir:Rc:l:P:x:vT:fSz:g:d:He:ZC",["site_name=","user_id=","password=","template_folder=","output_folder=","site_id=","manual_id=","article_id=","manual_file_name=","object_identifier=","jobs=","incremental","rate=","resume","capture=","replay=","processes=","report_folder=","verbose","timeout=","skip_failed","search_index","shard=","merge=","plan=","head","execute=","precompress","compact_json"])
     except getopt.GetoptError:
         print('use "run.py -h" for help')
         sys.exit(2)
@@ -186,408 +1506,1390 @@ def main(argv):
             print_help()
             sys.exit()
         elif opt in ("-n", "--site_name"):
-            site_name = arg
+            config.site_name = arg
         elif opt in ("-u", "--user_id"):
-            user_id = arg
+            config.user_id = arg
         elif opt in ("-p", "--password"):
-            api_token = arg
+            config.api_token = arg
         elif opt in ("-t", "--template_folder"):
-            template_folder = arg
+            config.template_folder = arg
         elif opt in ("-o", "--output_folder"):
-            output_folder = arg
+            config.output_folder = arg
         elif opt in ("-s", "--site_id"):
-            site_id = arg
+            config.site_id = arg
         elif opt in ("-m", "--manual_id"):
-            manual_id = arg
+            config.manual_id = arg
         elif opt in ("-a", "--article_id"):
-            article_id = arg
+            config.article_id = arg
         elif opt in ("-M", "--manual_file_name"):
-            if manual_id != "":
-                manual_file_name = arg
+            if config.manual_id != "":
+                config.manual_file_name = arg
         elif opt in ("-i", "--object_identifier"):
-            object_identifier = arg
-
-
-    # check if required attributes exist
-    if (site_name == '') or (user_id == '') or (api_token == ''):
-        print("Site_name, user_id, and password are required. Try 'run -h' if you need help.")
-        sys.exit()
-
-    # if the output isn't specified, just put it in their home directory
-    if (output_folder == ''):
-        output_folder = os.path.expanduser('~')
-
-    # if the template folder isn't specified, we'll just print out html files, otherwise we
-    # have some prep work to do.
-    if (template_folder == ''):
-        template_specified = False
-        is_article_folder = False
-        is_manual_files = False
-        is_image_folder = False
-        is_attach_folder = False
-        print("Warn: Template folder not specified.  Will output HTML files only.")
-    else:
+            config.object_identifier = arg
+        elif opt in ("-j", "--jobs"):
+            try:
+                config.jobs = max(1, int(arg))
+            except ValueError:
+                print("Error: -j must be a number. Try 'run -h' if you need help.")
+                sys.exit(2)
+        elif opt in ("-I", "--incremental"):
+            config.incremental = True
+        elif opt in ("-r", "--rate"):
+            try:
+                config.rate = float(arg)
+            except ValueError:
+                config.rate = 0
+        elif opt in ("-R", "--resume"):
+            config.resume = True
+        elif opt in ("-c", "--capture"):
+            config.capture_folder = arg
+        elif opt in ("-l", "--replay"):
+            config.replay_folder = arg
+        elif opt in ("-P", "--processes"):
+            try:
+                config.processes = max(1, int(arg))
+            except ValueError:
+                print("Error: -P must be a number. Try 'run -h' if you need help.")
+                sys.exit(2)
+        elif opt in ("-x", "--report_folder"):
+            config.report_folder = arg
+        elif opt in ("-v", "--verbose"):
+            config.verbose = True
+        elif opt in ("-T", "--timeout"):
+            try:
+                config.timeout = float(arg)
+            except ValueError:
+                config.timeout = 0
+        elif opt in ("-f", "--skip_failed"):
+            config.skip_failed = True
+        elif opt in ("-S", "--search_index"):
+            config.search_index = True
+        elif opt in ("-z", "--shard"):
+            config.shard = arg
+        elif opt in ("-g", "--merge"):
+            config.merge = arg
+        elif opt in ("-d", "--plan"):
+            config.plan = arg
+        elif opt in ("-H", "--head"):
+            config.head = True
+        elif opt in ("-e", "--execute"):
+            config.execute = arg
+        elif opt in ("-Z", "--precompress"):
+            config.precompress = True
+        elif opt in ("-C", "--compact_json"):
+            config.compact_json = True
+
+    try:
+        config.validate()
+    except ExportError as e:
+        print(_decode(e) + " Try 'run -h' if you need help.")
+        sys.exit(2)
+
+    return config
+
+def endpoint_type(endpoint):
+    # sites, site, manual, chapter or article, for labelling metrics
+    parts = endpoint.split('/')
+    if len(parts) == 1:
+        return parts[0]
+    if len(parts) == 2:
+        return 'site'
+    return parts[2].rstrip('s')
+
+def prometheus_text(report):
+    # the run report in the Prometheus textfile collector format
+    lines = []
+    for name, values in sorted(report['metrics'].items()):
+        lines.append('# HELP ss_exporter_' + name + ' ' + metric_help.get(name, name))
+        lines.append('# TYPE ss_exporter_' + name + ' counter')
+        for label, value in sorted(values.items()):
+            lines.append('ss_exporter_' + name + ('{' + label + '}' if label else '') + ' ' + repr(value))
+    run_gauges = [
+        ('run_finished', 'Whether the last export finished.', 1 if report['finished'] else 0),
+        ('run_seconds', 'How long the last export took.', report['seconds']),
+        ('run_articles', 'Articles in the last export.', report['articles']),
+        ('run_timestamp_seconds', 'When the last export finished.', round(time.time(), 3))]
+    for name, help_text, value in run_gauges:
+        lines.append('# HELP ss_exporter_' + name + ' ' + help_text)
+        lines.append('# TYPE ss_exporter_' + name + ' gauge')
+        lines.append('ss_exporter_' + name + ' ' + repr(value))
+    return '\n'.join(lines) + '\n'
+
+class ExportRun:
+    # One export. The config and the compiled templates are worked out when
+    # it's created. The journal, snapshot, session, scheduler, media store and
+    # pools are opened by open() in each process that does the exporting, and
+    # are left behind when the run is pickled for a worker process. Progress is
+    # reported by calling on_event with an event dict, see emit().
+    resources = ('journal', 'snapshot', 'session', 'scheduler', 'requester', 'media_store', 'executor', 'submit', 'pool', 'metrics', 'output', 'on_event', 'emit_lock', 'event_queue', 'event_thread', 'folder_locks')
+
+    def __init__(self, config, on_event=None):
+        config.validate()
+        for name, value in config.settings().items():
+            setattr(self, name, value)
+        for name in self.resources:
+            setattr(self, name, None)
+        self.on_event = on_event
+        self.emit_lock = threading.Lock()
+
+        # if the output isn't specified, just put it in their home directory.
+        # A plan keeps it as it was given, so -e resolves it the same way
+        self.output_setting = self.output_folder
+        if self.output_folder == '':
+            self.output_folder = os.path.expanduser('~')
+        self.resumed = False
+        self.own_session = False
+        self.failures = [] # articles skipped with -f
+        self.archive = archive_format(self.output_folder)
+        self.shard_index, self.shard_count = parse_shard(self.shard)
+        self.shard_sites = {} # what a shard exported, for the merge
+        self.article_index = {} # article id -> (site folder, manifest entry)
+        self.article_link_pattern = article_link_pattern(self.site_name)
+        self.merge_folders = split_ids(self.merge)
+        self.planned = {} # endpoint -> response from the plan run with -e
+        if self.execute != '':
+            self.planned = dict((endpoint, json.dumps(response)) for endpoint, response in json.loads(read_file(self.execute))['responses'].items())
+        self.site_ids = split_ids(self.site_id)
+        self.manual_ids = split_ids(self.manual_id)
+        self.article_ids = split_ids(self.article_id)
+        self.work_folder = self.output_folder
+        self.metrics = Metrics()
+        with self.metrics.timer('phase_seconds_total', ('phase', 'templates')):
+            self.load_templates()
+
+        # anything that changes how articles are written means an incremental
+        # export can't reuse what an earlier run left behind
+        export_signature = hashlib.sha1(self.object_identifier.encode('utf-8'))
+        if self.template_specified:
+            for path in sorted(self.article_files):
+                export_signature.update(os.path.relpath(path, self.template_folder).encode('utf-8'))
+                export_signature.update(json.dumps(self.article_files[path]['tokens']).encode('utf-8'))
+            if self.is_image_folder:
+                export_signature.update(self.at_images_folder.encode('utf-8'))
+            if self.is_attach_folder:
+                export_signature.update(self.at_attach_folder.encode('utf-8'))
+        if self.search_index:
+            export_signature.update(b'search')
+        export_signature.update(b'links')
+        if self.precompress:
+            export_signature.update(b'precompress')
+        if self.compact_json:
+            export_signature.update(b'compact')
+        self.export_signature = export_signature.hexdigest()
+        self.journal_signature = hashlib.sha1(json.dumps([self.export_signature, self.site_id, self.manual_id, self.article_id, self.manual_file_name, self.incremental, self.shard]).encode('utf-8')).hexdigest()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in self.resources:
+            state[name] = None
+        return state
+
+    # Every event is a dict with a 'type', the 'message' the command line
+    # prints for it, and the ids and titles it's about. The types are info,
+    # warning, sites, site, manual, chapter, article, media, failed,
+    # rate_limited, removed and finished. on_event is called one event at a time, even from
+    # the worker threads of -j. Worker processes of -P send theirs to the
+    # parent process, which calls it.
+    def emit(self, event_type, message, **fields):
+        if self.on_event is None:
+            return
+        fields['type'] = event_type
+        fields['message'] = message
+        with self.emit_lock:
+            self.on_event(fields)
+
+    def forward_events(self):
+        for event in iter(self.event_queue.get, None):
+            with self.emit_lock:
+                self.on_event(event)
+
+    def load_templates(self):
+        # if the template folder isn't specified, we'll just print out html files, otherwise we
+        # have some prep work to do.
+        if (self.template_folder == ''):
+            self.template_specified = False
+            self.is_article_folder = False
+            self.is_manual_files = False
+            self.is_image_folder = False
+            self.is_attach_folder = False
+            self.emit('warning', "Warn: Template folder not specified.  Will output HTML files only.")
+            return
+
         # check if template folder exists
-        if os.path.exists(template_folder):
-            template_specified = True
-
-            # check if folder has an @article folder
-            at_article_folder = find_dirs("@article",template_folder)
-
-            if len(at_article_folder) == 0:
-                print("Info: No @article folder found.")
-                is_article_folder = False
-            elif len(at_article_folder) == 1:
-                at_article_folder = at_article_folder[0]
-                print("Info: Template folder has @article folder. "  + _decode(at_article_folder))
-                is_article_folder = True
-            else:
-                print("Error: More than one @article folder found.")
-                sys.exit()
-
-            # check if folder has an @images folder
-            at_images_folder = find_file(image_folder_indicator,template_folder)
-
-            if len(at_images_folder) == 0:
-                print("Info: No " + image_folder_indicator + " file found.")
-                is_image_folder = False
-            elif len(at_images_folder) == 1:
-                at_images_folder = find_at_file_path(os.path.dirname(at_images_folder[0]),template_folder)
-                print("Info: Template folder has " + image_folder_indicator + " file. "  + _print(at_images_folder))
-                is_image_folder = True
-            else:
-                print("Error: More than one " + _print(image_folder_indicator) + " file found.")
-                sys.exit()
-
-            # check if folder has an @attachments folder
-            at_attach_folder = find_file(attach_folder_indicator,template_folder)
-
-            if len(at_attach_folder) == 0:
-                print("Info: No " + attach_folder_indicator + " file found.")
-                is_attach_folder = False
-            elif len(at_attach_folder) == 1:
-                at_attach_folder = find_at_file_path(os.path.dirname(at_attach_folder[0]),template_folder)
-                print("Info: Template folder has " + attach_folder_indicator + " file. "  + _print(at_attach_folder))
-                is_attach_folder = True
-            else:
-                print("Error: More than one " + attach_folder_indicator + " file found.")
-                sys.exit()
+        if not os.path.exists(self.template_folder):
+            raise ExportError("Error: Template folder not found. Try 'run -h' if you need help.")
+
+        self.template_specified = True
+        self.layout = plan_template(self.template_folder)
+
+        # check if folder has an @article folder
+        self.at_article_folder = self.layout['article_folders']
+
+        if len(self.at_article_folder) == 0:
+            self.emit('info', "Info: No @article folder found.")
+            self.is_article_folder = False
+        elif len(self.at_article_folder) == 1:
+            self.at_article_folder = self.at_article_folder[0]
+            self.emit('info', "Info: Template folder has @article folder. "  + _decode(self.at_article_folder))
+            self.is_article_folder = True
+        else:
+            raise ExportError("Error: More than one @article folder found.")
+        split_layout(self.layout, self.at_article_folder if self.is_article_folder else None)
+
+        # check if folder has an @images folder
+        self.at_images_folder = self.layout['images']
+
+        if len(self.at_images_folder) == 0:
+            self.emit('info', "Info: No " + image_folder_indicator + " file found.")
+            self.is_image_folder = False
+        elif len(self.at_images_folder) == 1:
+            self.at_images_folder = self.at_images_folder[0]
+            self.emit('info', "Info: Template folder has " + image_folder_indicator + " file. "  + _print(self.at_images_folder))
+            self.is_image_folder = True
+        else:
+            raise ExportError("Error: More than one " + _print(image_folder_indicator) + " file found.")
+
+        # check if folder has an @attachments folder
+        self.at_attach_folder = self.layout['attachments']
+
+        if len(self.at_attach_folder) == 0:
+            self.emit('info', "Info: No " + attach_folder_indicator + " file found.")
+            self.is_attach_folder = False
+        elif len(self.at_attach_folder) == 1:
+            self.at_attach_folder = self.at_attach_folder[0]
+            self.emit('info', "Info: Template folder has " + attach_folder_indicator + " file. "  + _print(self.at_attach_folder))
+            self.is_attach_folder = True
+        else:
+            raise ExportError("Error: More than one " + attach_folder_indicator + " file found.")
 
-            # now let's see if there are @article file(s). we'll take as many
-            # as you want, as long as there is at least one!
-            at_article_file = find_file(article_file_indicator,template_folder)
+        # now let's see if there are @article file(s). we'll take as many
+        # as you want, as long as there is at least one!
+        at_article_file = self.layout['article_templates']
 
-            if at_article_file == []:
-                print("Error: No @article file found.")
-                sys.exit()
+        if at_article_file == []:
+            raise ExportError("Error: No @article file found.")
 
-            # ok, phew we found at least one
-            else:
-                print("Info: @article file(s) found.")
+        # ok, phew we found at least one
+        else:
+            self.emit('info', "Info: @article file(s) found.")
 
-                # read in template data
-                article_files = {}
-                for each_article_file in at_article_file:
-                    article_files[each_article_file] = read_file(each_article_file)
+            # read in and compile template data
+            self.article_files = {}
+            for each_article_file in at_article_file:
+                self.article_files[each_article_file] = compile_article_template(each_article_file, self.template_folder)
 
-            # now let's check if theres a manual file
-            at_manual_file = find_file(manual_file_indicator,template_folder)
+        # now let's check if theres a manual file
+        at_manual_file = self.layout['toc_templates']
 
-            if at_manual_file == []:
-                print("Warn: No @toc file found.")
-                is_manual_files = False
-            else:
-                print("Info: @toc file(s) found.")
-                is_manual_files = True
+        if at_manual_file == []:
+            self.emit('warning', "Warn: No @toc file found.")
+            self.is_manual_files = False
+        else:
+            self.emit('info', "Info: @toc file(s) found.")
+            self.is_manual_files = True
 
-                # read in template data
-                manual_files = {}
-                manual_files_ref = {}
+            # read in template data
+            self.manual_files = {}
+            self.manual_files_ref = {}
 
-                for each_manual_file in at_manual_file:
-                    manual_files[each_manual_file] = read_file(each_manual_file)
+            for each_manual_file in at_manual_file:
+                self.manual_files[each_manual_file] = read_file(each_manual_file)
 
-                    # Each @manual file consists of pre-chapter block, chapter block, and post-chapter block
-                    # the chapter block then consists of the pre-article block, the article block, and post-article block
-                    chapter_split = re.split('{{chapter}}',manual_files[each_manual_file])
+                # Each @manual file consists of pre-chapter block, chapter block, and post-chapter block
+                # the chapter block then consists of the pre-article block, the article block, and post-article block
+                chapter_split = re.split('{{chapter}}',self.manual_files[each_manual_file])
 
-                    if len(chapter_split) < 3:
-                        chapter_split = ['',chapter_split[0],'']
+                if len(chapter_split) < 3:
+                    chapter_split = ['',chapter_split[0],'']
 
-                    article_split = re.split('{{article}}',chapter_split[1])
+                article_split = re.split('{{article}}',chapter_split[1])
 
-                    if len(article_split) < 3:
-                        add_end_manual_file = article_split[0]
-                        article_split = ['','','']
-                    else:
-                        add_end_manual_file = ''
+                if len(article_split) < 3:
+                    add_end_manual_file = article_split[0]
+                    article_split = ['','','']
+                else:
+                    add_end_manual_file = ''
+
+                self.manual_files_ref[each_manual_file] = [compile_template(block) for block in [
+                                            chapter_split[0], # 0 - pre-chapter
+                                            article_split[0], # 1 - pre-article (chapter)
+                                            article_split[1], # 2 - article
+                                            article_split[2], # 3 - post-article (chapter)
+                                            chapter_split[2], # 4 - post-chapter
+                                            add_end_manual_file]] # 5 - end of file
+
+    def open(self, worker=False, session=None):
+        if self.metrics is None:
+            self.metrics = Metrics()
+            self.emit_lock = threading.Lock()
+
+        # a plan only writes the plan file, so what the run needs on disk goes
+        # in a scratch folder that's removed with it. An archive is streamed
+        # to as the export goes, from a scratch folder next to it
+        if self.plan != '' and not worker:
+            self.work_folder = tempfile.mkdtemp(prefix='ss_exporter_plan.')
+            self.output = folder_output
+        elif self.archive is not None and not worker:
+            archive_folder = os.path.dirname(os.path.abspath(self.output_folder))
+            make_dir(archive_folder)
+            self.work_folder = tempfile.mkdtemp(prefix='.ss_exporter.', dir=archive_folder)
+            self.output = ArchiveOutput(self.output_folder, self.work_folder)
+        else:
+            self.output = folder_output
+        if self.precompress:
+            # the compressed copies are cached in the media store, which
+            # removes them when it's closed
+            self.output = PrecompressedOutput(self.output, self.metrics, os.path.join(self.work_folder, media_store_folder, precompressed_folder_name))
+            if brotli is None and not worker:
+                self.emit('warning', "Warn: The brotli package isn't installed, so only .gz files are written with -Z.")
+
+        # finished work is checkpointed so an interrupted run can be resumed
+        make_dir(self.work_folder)
+        self.journal = Journal(os.path.join(self.work_folder, journal_file_name), self.journal_signature, self.resume or self.resumed, attach=worker)
+        self.resumed = self.journal.resumed
+        if not worker:
+            if self.journal.resumed:
+                self.emit('info', "Info: Resuming export. " + _decode(len(self.journal.articles)) + " articles were already done.")
+            elif self.resume:
+                self.emit('warning', "Warn: No checkpoint from an earlier run of this export found. Starting from the beginning.")
+
+        if self.capture_folder != '':
+            self.snapshot = Snapshot(self.capture_folder, 'capture', append=self.journal.resumed)
+        elif self.replay_folder != '':
+            self.snapshot = Snapshot(self.replay_folder, 'replay')
+            if not worker:
+                self.emit('info', "Info: Replaying " + _decode(len(self.snapshot.responses)) + " API responses and " + _decode(len(self.snapshot.media)) + " media files from " + _decode(self.replay_folder))
+
+        # set up request, on the caller's session if there is one. with -P each
+        # process gets its share of the rate. The media store is only kept between
+        # runs of an incremental export
+        self.own_session = session is None
+        self.session = session or new_session(self.jobs)
+        self.scheduler = RequestScheduler(self.jobs, self.rate / self.processes if self.rate is not None else None, self.metrics)
+        self.requester = Requester(self.session, self.metrics, self.emit, self.timeout)
+        store_folder = os.path.join(self.work_folder, media_store_folder)
+        self.media_store = MediaStore(store_folder, self.requester, self.snapshot, self.metrics, self.output, keep=self.incremental)
+
+        # articles are handed to a pool of workers when -j is more than 1,
+        # otherwise they're exported inline as they're found
+        if self.jobs > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+            self.submit = self.executor.submit
+        else:
+            self.submit = run_now
+
+        # manuals are handed to a pool of processes when -P is more than 1.
+        # they're spawned rather than forked so they don't inherit our threads.
+        # Articles written to the same folder (like two titled "Overview" with
+        # -i title) take turns, through locks shared with the processes
+        if self.processes > 1 and not worker:
+            context = multiprocessing.get_context('spawn')
+            self.folder_locks = [context.Lock() for i in range(folder_lock_count)]
+            if self.on_event is not None:
+                self.event_queue = context.Queue()
+                self.event_thread = threading.Thread(target=self.forward_events, daemon=True)
+                self.event_thread.start()
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, mp_context=context, initializer=start_worker, initargs=(self, self.event_queue, self.folder_locks))
+        elif not worker:
+            self.folder_locks = [threading.Lock() for i in range(folder_lock_count)]
+
+    def folder_lock(self, path):
+        digest = hashlib.sha1(os.path.normpath(path).encode('utf-8')).hexdigest()
+        return self.folder_locks[int(digest[:8], 16) % len(self.folder_locks)]
+
+    def close(self, finished):
+        # jobs already running are waited for, since they still use the media
+        # store, the journal and the output closed below
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        if self.event_thread is not None:
+            self.event_queue.put(None)
+            self.event_thread.join()
+        # and whatever open() got to, if it failed part way
+        if self.own_session and self.session is not None:
+            self.session.close()
+        if self.media_store is not None:
+            self.media_store.close()
+        if self.journal is not None:
+            self.journal.close(finished)
+        if self.snapshot is not None:
+            self.snapshot.close()
+        if self.output is not None and finished:
+            self.output.close()
+        elif self.output is not None:
+            self.output.abort()
+        if self.work_folder != self.output_folder:
+            remove_directory(self.work_folder)
+
+    # the run report and Prometheus textfile, written to the -x folder whether
+    # or not the export finished. They're kept out of the output, which is
+    # what gets published
+    def write_reports(self, finished, started, seconds):
+        articles = self.metrics.total('articles_exported_total') + self.metrics.total('articles_skipped_total')
+        report = {
+            'finished': finished,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            'seconds': round(seconds, 3),
+            'articles': articles,
+            'articles_per_second': round(articles / seconds, 2) if seconds > 0 else 0,
+            'api_requests': self.metrics.total('api_requests_total'),
+            'failed_articles': self.failures,
+            'metrics': {}}
+        for (name, label), value in self.metrics.items():
+            report['metrics'].setdefault(name, {})[metric_label(label)] = round(value, 6)
+        if self.report_folder == '':
+            return report
+        try:
+            make_dir(self.report_folder)
+            write_file(self.report_folder, report_file_name, json.dumps(report, sort_keys=True, indent=2, separators=(',', ': ')))
+            write_file(self.report_folder, prometheus_file_name, prometheus_text(report))
+        except OSError as e:
+            if finished:
+                raise ExportError("Error: Couldn't write the run report: " + _decode(e)) from e
+            # the error that stopped the export is the one raised
+            self.emit('warning', "Warn: Couldn't write the run report: " + _decode(e))
+        return report
+
+    def screensteps_json(self, endpoint):
+        if endpoint in self.planned:
+            self.metrics.add('api_requests_saved_total', 1, ('endpoint', endpoint_type(endpoint)))
+            text = self.planned[endpoint]
+            if self.snapshot is not None:
+                self.snapshot.save_response(endpoint, text)
+            return text
+        if self.snapshot is not None and self.snapshot.mode == 'replay':
+            return self.snapshot.response(endpoint)
+        base_url = 'https://' + self.site_name + '.screenstepslive.com/api/v2/'
+        site_endpoint = base_url + endpoint
+        label = ('endpoint', endpoint_type(endpoint))
+        def observe(r, seconds):
+            self.metrics.add('api_requests_total', 1, label)
+            self.metrics.add('api_request_seconds_total', seconds, label)
+            self.metrics.add('api_response_bytes_total', len(r.content), label)
+            if r.status_code == 429:
+                self.metrics.add('api_rate_limited_total', 1, label)
+        text = self.requester.get(site_endpoint, lambda r: r.text, auth=(self.user_id, self.api_token), scheduler=self.scheduler, observe=observe)
+        if self.snapshot is not None:
+            self.snapshot.save_response(endpoint, text)
+        return text
+
+    def screensteps(self, endpoint):
+        rawtext = self.screensteps_json(endpoint)
+        return json.loads(rawtext)
+
+    # fetch, download and render one article. Runs on a worker thread when -j is
+    # more than 1, so it only touches the article's own files and returns the
+    # manifest entry the TOC is built from. If the entry from the last
+    # incremental run is still current it's returned as is.
+    def export_article(self, site_folder, this_site_id, article, previous=None, fetched=None):
+        this_article_id = _decode(article['id'])
+        if is_current(site_folder, previous, article.get('last_edited_at')):
+            self.emit('article', ">>>>> Unchanged article: " + _print(article['title']), site=this_site_id, id=this_article_id, title=article['title'], status='unchanged')
+            self.metrics.add('articles_skipped_total', 1, ('reason', 'unchanged'))
+            return previous
+
+        self.emit('article', ">>>>> Processing article: " + _print(article['title']), site=this_site_id, id=this_article_id, title=article['title'], status='exporting')
+        # print(">>>>> " + _print(article))
+
+        if fetched is not None:
+            this_article = fetched # already looked up for -a
+        else:
+            this_article = self.screensteps('sites/' + this_site_id + '/articles/' + this_article_id) # grab ind article
+
+        if is_current(site_folder, previous, this_article['article']['last_edited_at']):
+            self.emit('article', ">>>>> Unchanged article: " + _print(article['title']), site=this_site_id, id=this_article_id, title=article['title'], status='unchanged')
+            self.metrics.add('articles_skipped_total', 1, ('reason', 'unchanged'))
+            return previous
 
-                    manual_files_ref[each_manual_file] = [
-                                                chapter_split[0], # 0 - pre-chapter
-                                                article_split[0], # 1 - pre-article (chapter)
-                                                article_split[1], # 2 - article
-                                                article_split[2], # 3 - post-article (chapter)
-                                                chapter_split[2]] # 4 - post-chapter
+        this_article_title = this_article['article']['title']
 
-        # template folder didn't exist
+        if self.object_identifier == "title_id":
+            this_article_identifier = prepare_for_filename(this_article_title) + " [" + this_article_id + "]"
+        elif self.object_identifier == "title":
+            this_article_identifier = prepare_for_filename(this_article_title)
         else:
-            print("Error: Template folder not found. Try 'run -h' if you need help.")
-            sys.exit()
+            this_article_identifier = this_article_id
+
+        # the media is downloaded before anything is written, so an article
+        # that fails (and is skipped with -f) leaves its earlier export alone
+        for content_block in this_article['article']['content_blocks']:
+            if 'url' in content_block:
+                self.media_store.fetch(content_block['url'])
+
+        # another article with the same identifier waits for this one to be
+        # written, instead of laying out the folder under it
+        with self.folder_lock(os.path.join(site_folder, this_article_identifier)):
+            article_folders = []
+            if self.is_article_folder:
+                article_folder = os.path.join(site_folder, find_relative_path(self.at_article_folder,self.template_folder), this_article_identifier)
+                with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'layout')):
+                    lay_out_article(self.layout, article_folder, self.output)
+                article_folders.append(os.path.relpath(article_folder, site_folder))
+            else:
+                # write html to a file if no templates
+                article_folder = site_folder
+
+            article_html = this_article['article']['html_body']
+
+            # loop through attached files
+            this_articles_files = []
+            article_media = []
+            for content_block in this_article['article']['content_blocks']:
+                if 'url' in content_block:
+
+                    # what type of file is it?
+                    download_ext = os.path.splitext(urlparse(content_block['url']).path)[1]
+                    if content_block['type'] == 'AttachmentContent': # attachment
+                        if self.is_attach_folder:
+                            files_folder = os.path.join(site_folder,self.at_attach_folder)
+                            short_files_folder = self.at_attach_folder
+                            if '@article' in files_folder:
+                                files_folder = files_folder.replace("@article", this_article_identifier)
+                                short_files_folder = short_files_folder.replace("@article", this_article_identifier)
+                        else:
+                            files_folder = os.path.join(article_folder, 'attachments')
+                            short_files_folder = 'attachments'
+                            self.output.make_dir(files_folder)
+                    else: # image
+                        if self.is_image_folder:
+                            files_folder = os.path.join(site_folder,self.at_images_folder)
+                            short_files_folder = self.at_images_folder
+                            if '@article' in files_folder:
+                                files_folder = files_folder.replace("@article", this_article_identifier)
+                                short_files_folder = short_files_folder.replace("@article", this_article_identifier)
+                        else:
+                            files_folder = os.path.join(article_folder, 'images')
+                            short_files_folder = 'images'
+                            self.output.make_dir(files_folder)
+
+                    self.emit('media', ">>>>>> Processing " + _print(content_block['type']) + ": " + _print(content_block['url']), site=this_site_id, article=this_article_id, kind=content_block['type'], url=content_block['url'])
+                    self.output.make_dir(files_folder)
+                    new_file_path = self.media_store.place(files_folder,content_block['url'])
+                    this_articles_files.append([ _decode(content_block['url']), os.path.join(short_files_folder,new_file_path)])
+                    article_media.append(os.path.relpath(os.path.join(files_folder, new_file_path), site_folder))
+
+            article_fields = dict((h, this_article['article'][h]) for h in article_handlebars)
+
+            article_files_paths = []
+            article_links = set() # articles linked to that weren't exported yet
+            if self.template_specified:
+                # take off any query params, and also swap thumbnail images for the downloaded file
+                rewrites = []
+                for this_articles_file in this_articles_files:
+                    image_url = this_articles_file[0].split("?", 1)[0]
+                    local_path = this_articles_file[1].replace("\\", "/") # Fix windows paths
+                    rewrites.append([image_url, local_path])
+                    rewrites.append([image_url.replace("/original/", "/medium/"), local_path])
+                rewrite_urls = url_rewriter(rewrites)
+
+                values = dict((h, _decode(v)) for h, v in article_fields.items())
+                values['html'] = article_html
+
+                # step through each file that starts with "@article"
+                for path, template in self.article_files.items():
+
+                    temp_filename = this_article_identifier + template['extension']
+                    if template['relative_path'] != '':
+                        temp_filename = os.path.join(template['relative_path'].replace("@article", this_article_identifier),temp_filename)
+
+                    label = ('template', os.path.relpath(path, self.template_folder))
+                    with self.metrics.timer('render_seconds_total', label):
+                        if template['uses_json'] and 'json' not in values:
+                            values['json'] = self.json_text(this_article)
+
+                        temp_towrite = rewrite_urls(render_template(template['tokens'], values), template['back_dir'])
+                        temp_towrite, missing = self.rewrite_article_links(temp_towrite, os.path.join(site_folder, temp_filename), 'render')
+                        article_links.update(missing)
+                    self.metrics.add('renders_total', 1, label)
+
+                    # write file
+                    with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'article')):
+                        self.write_article_file(site_folder, temp_filename, temp_towrite, missing)
+                    article_files_paths.append(temp_filename)
+            else:
+                label = ('template', 'html')
+                with self.metrics.timer('render_seconds_total', label):
+                    rewrite_urls = url_rewriter([[f[0], f[1].replace("\\", "/")] for f in this_articles_files]) # Fix windows paths
+                    temp_towrite = rewrite_urls(article_html)
+                    temp_towrite, missing = self.rewrite_article_links(temp_towrite, os.path.join(article_folder, this_article_identifier + '.html'), 'render')
+                    article_links.update(missing)
+                self.metrics.add('renders_total', 1, label)
+                with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'article')):
+                    self.write_article_file(article_folder, (this_article_identifier + '.html'), temp_towrite, missing)
+                article_files_paths.append((this_article_identifier + '.html'))
+        self.metrics.add('articles_exported_total')
+
+        entry = {
+            'id': this_article['article']['id'],
+            'last_edited_at': this_article['article']['last_edited_at'],
+            'identifier': this_article_identifier,
+            'fields': article_fields,
+            'files': article_files_paths,
+            'media': article_media,
+            'folders': article_folders}
+        if self.search_index:
+            with self.metrics.timer('render_seconds_total', ('template', 'search')):
+                entry['search'] = search_document(article_fields, article_html)
+        if len(article_links) > 0:
+            entry['links'] = sorted(article_links)
+        return entry
+
+    # an archive entry can't be rewritten, so a file with links to articles
+    # that aren't exported yet waits in the scratch folder for the deferred
+    # pass to add it
+    def write_article_file(self, directory, name, text, missing):
+        if self.archive is not None and len(missing) > 0:
+            write_file(directory, name, text)
+        else:
+            self.output.write_file(directory, name, text)
+
+    # {{json}} is pretty printed, or as small as it gets with -C
+    def json_text(self, value):
+        if self.compact_json:
+            return json.dumps(value, sort_keys=True, separators=(',', ':'))
+        return json.dumps(value, sort_keys=True, indent=2, separators=(',', ': '))
+
+    # the article index is what links between articles are rewritten from
+    def index_article(self, site_folder, entry):
+        self.article_index[_decode(entry['id'])] = (site_folder, entry)
+
+    # point the links to other articles in the text of the file at path at
+    # their exported files, in one pass. Returns the text and the ids of the
+    # linked articles that aren't in the index (yet)
+    def rewrite_article_links(self, text, path, when):
+        extension = os.path.splitext(path)[1]
+        if extension not in article_link_extensions:
+            return text, []
+        missing = []
+        def replace(match):
+            target = self.article_index.get(match.group(1))
+            if target is None:
+                missing.append(match.group(1))
+                return match.group(0)
+            site_folder, entry = target
+            for name in entry['files']:
+                if os.path.splitext(name)[1] == extension:
+                    self.metrics.add('article_links_rewritten_total', 1, ('pass', when))
+                    return os.path.relpath(os.path.join(site_folder, name), os.path.dirname(path)).replace("\\", "/") # Fix windows paths
+            return match.group(0)
+        return self.article_link_pattern.sub(replace, text), missing
+
+    # the files of articles that were rendered before articles they link to
+    # were exported. entries are (site folder, entry, source folder) and the
+    # files are read from the source folder, which is the output folder
+    # unless they're merged from a shard. The files an archive held back are
+    # all of them, whether or not their links can be pointed anywhere now
+    def pending_link_files(self, entries):
+        for site_folder, entry, source_folder in entries:
+            links = entry.get('links', [])
+            if (self.archive is not None and len(links) > 0) or any(target in self.article_index for target in links):
+                for name in entry['files']:
+                    path = os.path.join(site_folder, name)
+                    source_path = os.path.join(source_folder, os.path.relpath(path, self.work_folder))
+                    if os.path.splitext(path)[1] in article_link_extensions and (self.archive is None or os.path.exists(source_path)):
+                        yield path, source_path
+
+    # those links are rewritten once the whole export is in the index
+    def rewrite_pending_links(self, entries):
+        for path, source_path in self.pending_link_files(entries):
+            with open(source_path, encoding='utf-8') as f:
+                text = f.read()
+            rewritten = self.rewrite_article_links(text, path, 'deferred')[0]
+            if rewritten != text or source_path != path or self.archive is not None:
+                with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'links')):
+                    self.output.write_file(os.path.dirname(path), os.path.basename(path), rewritten)
+
+    # articles an interrupted run already finished are reused, everything else
+    # is exported and checkpointed
+    def export_and_record(self, site_folder, this_site_id, this_manual_id, article, previous, fetched=None):
+        finished = self.journal.articles.get((this_site_id, _decode(article['id'])))
+        if finished is not None and files_exist(site_folder, finished):
+            self.emit('article', ">>>>> Already exported article: " + _print(article['title']), site=this_site_id, id=_decode(article['id']), title=article['title'], status='resumed')
+            self.metrics.add('articles_skipped_total', 1, ('reason', 'resumed'))
+            return finished
+        try:
+            entry = self.export_article(site_folder, this_site_id, article, previous, fetched)
+        except ExportError as e:
+            if not self.skip_failed:
+                raise
+            # skipped and reported, keeping what an earlier run wrote if there is any
+            self.metrics.add('articles_failed_total')
+            self.failures.append({'site': this_site_id, 'id': _decode(article['id']), 'title': article['title'], 'error': _decode(e)})
+            self.emit('failed', "Warn: Skipped article " + _print(article['title']) + ". " + _decode(e), site=this_site_id, id=_decode(article['id']), title=article['title'], error=_decode(e))
+            if previous is not None and files_exist(site_folder, previous):
+                return previous
+            return None
+        with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'journal')):
+            self.journal.record({'type': 'article', 'site': this_site_id, 'manual': this_manual_id, 'entry': entry})
+        self.index_article(site_folder, entry)
+        return entry
+
+    def render_toc(self, path, toc_writer, block, values):
+        with self.metrics.timer('render_seconds_total', ('template', os.path.relpath(path, self.template_folder))):
+            toc_writer.write_template(self.manual_files_ref[path][block], values)
+
+    # add a chapter's articles to the TOC files once they've all been exported
+    def finish_chapter(self, pending_chapter, this_manual_id, toc_writers, entries):
+        chapter, article_jobs = pending_chapter
+
+        # pre-article replaces on manual_files_ref[path][1]
+        for path, toc_writer in toc_writers.items():
+            self.render_toc(path, toc_writer, 1, {'title': chapter['title']})
+
+        for article_job in article_jobs:
+            this_article = article_job.result()
+            if this_article is None:
+                continue # it failed and was skipped
+            this_article['manual'] = this_manual_id
+            entries.append(this_article)
+
+            # Add to list of article ids and titles
+            chapter["articles"].append( {'id': this_article['id'], 'title': this_article['identifier']} )
+
+            # article replaces on manual_files_ref[path][2]
+            values = dict((h, _decode(v)) for h, v in this_article['fields'].items())
+            for path, toc_writer in toc_writers.items():
+                try:
+                    values['link'] = next(i for i in this_article['files'] if os.path.splitext(i)[1] ==  os.path.splitext(path)[1])
+                except:
+                    raise ExportError("Error: We didn't find a file extension match for the article from the TOC with: " + os.path.splitext(path)[1])
+                self.render_toc(path, toc_writer, 2, values)
 
-    # set up request
-    def screensteps_json(endpoint):
-        base_url = 'https://' + site_name + '.screenstepslive.com/api/v2/'
-        site_endpoint = base_url + endpoint
+        # post-article replaces on manual_files_ref[path][3]
+        for path, toc_writer in toc_writers.items():
+            self.render_toc(path, toc_writer, 3, {'title': _decode(chapter['title'])})
+
+    # open the TOC files of a manual and write everything before the first chapter
+    def open_tocs(self, site_folder, this_manual_identifier, chapters):
+        toc_writers = {}
         try:
-            while True:
-                r = requests.get(site_endpoint, auth=(user_id, api_token))
+            if self.is_manual_files: # are there templates?
+                for path, details in self.manual_files.items():
+                    manual_relative_path = find_relative_path(path,self.template_folder)
+                    if manual_relative_path == '':
+                        manual_relative_path = site_folder
+                    else:
+                        manual_relative_path = os.path.join(site_folder,manual_relative_path)
 
-                if r.status_code == 200:
-                    return r.text
-                elif r.status_code == 429:
-                    # Rate limit exceeded
-                    try:
-                        retry_info = r.json()
-                        retry_in = retry_info.get('retry_in', 60)  # Default to 60 seconds if not provided
-                        print(f"Rate limit exceeded. Retrying in {retry_in} seconds...")
-                        time.sleep(retry_in)
-                    except ValueError:
-                        # Failed to parse JSON, fall back to a default wait time
-                        print("Rate limit exceeded. Retrying in 60 seconds (default)...")
-                        time.sleep(60)
-                else:
-                    print('Error connecting to server (' + _decode(r.status_code) + ')')
-                    sys.exit(2)
-        except requests.exceptions.RequestException as e:
-            print("Error connecting to server:", e)
-            sys.exit(2)
-
-    def screensteps(endpoint):
-        rawtext = screensteps_json(endpoint)
-        return json.loads(rawtext)
+                    if self.manual_file_name != "":
+                        temp_filename = self.manual_file_name + os.path.splitext(path)[1]
+                    else:
+                        temp_filename = this_manual_identifier + os.path.splitext(path)[1]
+                    toc_writers[path] = TocWriter(manual_relative_path, temp_filename, self.output)
+
+                    # pre-chapter replaces on manual_files_ref[path][0]
+                    self.render_toc(path, toc_writers[path], 0, {'title': chapters['manual']['title']})
+        except:
+            for toc_writer in toc_writers.values():
+                toc_writer.abort()
+            raise
+        return toc_writers
+
+    # finish a manual's TOC files and write its search index once all its
+    # chapters are in. Returns the files written
+    def close_tocs(self, site_folder, this_manual_identifier, chapters, toc_writers, entries):
+        # post-chapter replaces on manual_files_ref[path][4]
+        toc_files = []
+        if self.is_manual_files: # are there templates?
+            chapters_json = ''
+            for path, toc_writer in toc_writers.items():
+                self.render_toc(path, toc_writer, 4, {'title': chapters['manual']['title']})
+                self.render_toc(path, toc_writer, 5, {})
+                if len(toc_writer.json_offsets) > 0 and chapters_json == '':
+                    chapters_json = self.json_text(chapters)
+                with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'toc')):
+                    toc_writer.close(chapters_json)
+                self.metrics.add('renders_total', 1, ('template', os.path.relpath(path, self.template_folder)))
+                toc_files.append(os.path.relpath(toc_writer.path, site_folder))
+
+        # the search index goes next to the first TOC, or in the site folder
+        if self.search_index:
+            if len(toc_writers) > 0:
+                index_path = os.path.splitext(toc_writers[sorted(toc_writers)[0]].path)[0] + search_index_extension
+            else:
+                index_path = os.path.join(site_folder, (self.manual_file_name or this_manual_identifier) + search_index_extension)
+            index = build_search_index(chapters['manual'], entries, site_folder, os.path.dirname(index_path))
+            with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'search')):
+                self.output.write_file(os.path.dirname(index_path), os.path.basename(index_path), json.dumps(index, sort_keys=True, separators=(',', ':')))
+            toc_files.append(os.path.relpath(index_path, site_folder))
+        return toc_files
+
+    # the articles of a chapter, as a future. The manual response can list
+    # them already, -a may have looked them up, and otherwise the chapter is
+    # fetched on the executor so listings are requested ahead of the walk
+    def list_articles(self, this_site_id, chapter, targets):
+        this_chapter_id = _decode(chapter['id'])
+        if targets is not None:
+            return run_now(list, [target['article'] for target in targets if _decode(target['article']['chapter_id']) == this_chapter_id])
+        if isinstance(chapter.get('articles'), list):
+            self.metrics.add('api_requests_saved_total', 1, ('endpoint', 'chapter'))
+            return run_now(list, chapter['articles'])
+        return self.submit(lambda: self.screensteps('sites/' + this_site_id + '/chapters/' + this_chapter_id)['chapter']['articles'])
+
+    # articles are spread over the shards by a hash of their ids, so every
+    # shard picks the same ones whatever order the API lists them in
+    def in_shard(self, this_site_id, this_article_id):
+        if self.shard_count == 0:
+            return True
+        digest = hashlib.sha1((this_site_id + '/' + this_article_id).encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) % self.shard_count == self.shard_index - 1
+
+    # export one manual, its articles and its TOC files. This is the unit of
+    # work handed to a worker process with -P. Returns the TOC files written
+    # and the manifest entries of the manual's articles. targets are the
+    # articles -a looked up directly, so their chapters needn't be listed.
+    # A shard of an export (-z) only exports its share of the articles and
+    # leaves the TOC files to the merge, returning what the merge needs.
+    def export_manual(self, this_site_id, site_folder, manual, reusable, targets=None):
+        start = time.perf_counter()
+        this_manual_id = _decode(manual['id'])
+        self.emit('manual', ">>> Processing manual: " + _print(manual['title']), site=this_site_id, id=this_manual_id, title=manual['title'], status='exporting')
+        # print(">>> " + _print(manual))
+
+        if self.object_identifier == "title_id":
+            this_manual_identifier = prepare_for_filename(manual["title"]) + " [" + this_manual_id + "]"
+        elif self.object_identifier == "title":
+            this_manual_identifier = prepare_for_filename(manual["title"])
+        else:
+            this_manual_identifier = this_manual_id
 
-    # grab all sites for that user information
-    print("> Pulling sites")
-    sites = screensteps('sites') # grab sites
-    print("> " + _print(str(sites)))
+        chapters = self.screensteps('sites/' + this_site_id + '/manuals/' + this_manual_id) # grab chapters
+        shard = None
+        if self.shard_count > 0:
+            shard = {'identifier': this_manual_identifier, 'chapters': json.loads(json.dumps(chapters)), 'order': {}}
 
-    # loop through sites
-    for site in sites['sites']:
+        toc_writers = {}
+        entries = []
+        try:
+            if shard is None:
+                toc_writers = self.open_tocs(site_folder, this_manual_identifier, chapters)
+
+            # walk the chapters, queueing up the articles as we go. Chapters are
+            # written to the TOC in order as soon as all their articles are done.
+            # The article listings of the next -j chapters are fetched ahead.
+            pending_chapters = collections.deque()
+            listings = collections.deque()
+            upcoming = iter(chapters['manual']['chapters'])
+            for chapter in chapters['manual']['chapters']:
+                for next_chapter in itertools.islice(upcoming, self.jobs + 1 - len(listings)):
+                    listings.append(self.list_articles(this_site_id, next_chapter, targets))
+                this_chapter_id = _decode(chapter['id'])
+                self.emit('chapter', ">>>> Processing chapter: " + _print(chapter['title']), site=this_site_id, manual=this_manual_id, id=this_chapter_id, title=chapter['title'])
+                # print(">>>> " + _print(chapter))
+
+                articles = listings.popleft().result() # grab articles
+                chapter['articles'] = []
+                fetched = dict((_decode(target['article']['id']), target) for target in targets or [])
+
+                article_jobs = []
+                for article in articles:
+                    this_article_id = _decode(article['id'])
+                    if selected(self.article_ids, this_article_id): # only action an article if article_id isn't set, or is a match
+                        if shard is not None:
+                            shard['order'].setdefault(this_chapter_id, []).append(this_article_id)
+                            if not self.in_shard(this_site_id, this_article_id):
+                                continue
+                        article_jobs.append(self.submit(self.export_and_record, site_folder, this_site_id, this_manual_id, article, reusable.get(this_article_id), fetched.get(this_article_id)))
+                pending_chapters.append((chapter, article_jobs))
+
+                while len(pending_chapters) > 0 and all(job.done() for job in pending_chapters[0][1]):
+                    self.finish_chapter(pending_chapters.popleft(), this_manual_id, toc_writers, entries)
+
+            while len(pending_chapters) > 0:
+                self.finish_chapter(pending_chapters.popleft(), this_manual_id, toc_writers, entries)
+
+            toc_files = []
+            if shard is None:
+                toc_files = self.close_tocs(site_folder, this_manual_identifier, chapters, toc_writers, entries)
+        finally:
+            for toc_writer in toc_writers.values():
+                toc_writer.abort()
+
+        exported = {'manual': this_manual_id, 'files': toc_files, 'articles': entries}
+        if shard is not None:
+            shard['articles'] = entries
+            exported['shard'] = shard
+        self.journal.record(dict(exported,
+            type='manual',
+            site=this_site_id,
+            articles=[_decode(entry['id']) for entry in entries]))
+        self.metrics.add('phase_seconds_total', time.perf_counter() - start, ('phase', 'manuals'))
+        return exported
+
+    # lay out a site's folder and start exporting its manuals, in this process
+    # or on the process pool
+    def start_site(self, site):
+        start = time.perf_counter()
         this_site_id = _decode(site['id'])
-        if (site_id == this_site_id) or (site_id == ''): # only action a site if site_id isn't set, or is a match
-            print(">> Processing site: " + _print(site['title']))
-            # print(">> " + _print(site))
-
-            # folder for site - two paths 1) template folder, 2) no template folder
-            if object_identifier == "title_id":
-                site_folder = os.path.join(output_folder, prepare_for_filename(site['title']) + " [" + this_site_id + "]")
-            elif object_identifier == "title":
-                site_folder = os.path.join(output_folder, prepare_for_filename(site['title']))
-            else:
-                site_folder = os.path.join(output_folder, this_site_id)
+        self.emit('site', ">> Processing site: " + _print(site['title']), id=this_site_id, title=site['title'], status='exporting')
+        # print(">> " + _print(site))
+
+        # folder for site - two paths 1) template folder, 2) no template folder
+        if self.object_identifier == "title_id":
+            site_folder = os.path.join(self.work_folder, prepare_for_filename(site['title']) + " [" + this_site_id + "]")
+        elif self.object_identifier == "title":
+            site_folder = os.path.join(self.work_folder, prepare_for_filename(site['title']))
+        else:
+            site_folder = os.path.join(self.work_folder, this_site_id)
+
+        if self.template_specified:
+            # an incremental or resumed export keeps what's already there
+            if not self.incremental and not self.journal.resumed:
+                remove_directory(site_folder)
+            with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'layout')):
+                lay_out_site(self.layout, site_folder, self.output)
+        else:
+            self.output.make_dir(site_folder)
 
-            if template_specified:
-                copy_and_overwrite(template_folder, site_folder)
+        if self.incremental:
+            old_manifest = read_manifest(site_folder)
+            if old_manifest['signature'] == self.export_signature:
+                reusable = old_manifest['articles']
             else:
-                make_dir(site_folder)
+                reusable = {}
+            manifest = {'signature': self.export_signature, 'articles': {}, 'manuals': {}}
+        else:
+            old_manifest = None
+            reusable = {}
+            manifest = None
 
-            manuals = screensteps('sites/' + this_site_id) #grab manuals
+        if self.shard_count > 0:
+            self.shard_sites[this_site_id] = {'folder': os.path.relpath(site_folder, self.work_folder), 'manuals': {}}
 
-            # loop through manuals
-            for manual in manuals['site']['manuals']:
+        if 'manuals' in site:
+            manuals = {'site': site} # the site was looked up directly
+        else:
+            manuals = self.screensteps('sites/' + this_site_id) #grab manuals
+
+        # articles picked with -a in a single site are looked up directly, and
+        # only the manuals and chapters they're in are exported
+        targets = None
+        if len(self.article_ids) > 0 and len(self.site_ids) == 1:
+            targets = {}
+            for this_article_id in self.article_ids:
+                target = self.screensteps('sites/' + this_site_id + '/articles/' + this_article_id) # grab ind article
+                targets.setdefault(_decode(target['article']['manual_id']), []).append(target)
+        self.metrics.add('phase_seconds_total', time.perf_counter() - start, ('phase', 'sites'))
+
+        # loop through manuals
+        manual_jobs = []
+        for manual in manuals['site']['manuals']:
+            this_manual_id = _decode(manual['id'])
+            if not selected(self.manual_ids, this_manual_id) or (targets is not None and this_manual_id not in targets): # only action a manual if manual isn't set, or is a match
+                continue
+            finished_manual = self.journal.manuals.get((this_site_id, this_manual_id))
+            manual_targets = targets[this_manual_id] if targets is not None else None
+            if finished_manual is not None:
+                self.emit('manual', ">>> Already exported manual: " + _print(manual['title']), site=this_site_id, id=this_manual_id, title=manual['title'], status='resumed')
+                if self.shard_count > 0:
+                    self.shard_sites[this_site_id]['manuals'][this_manual_id] = finished_manual['shard']
+                for this_id in finished_manual['articles']:
+                    if (this_site_id, this_id) in self.journal.articles:
+                        self.index_article(site_folder, self.journal.articles[(this_site_id, this_id)])
+                if self.incremental:
+                    manifest['manuals'][this_manual_id] = {'files': finished_manual['files']}
+                    for this_id in finished_manual['articles']:
+                        if (this_site_id, this_id) in self.journal.articles:
+                            manifest['articles'][this_id] = self.journal.articles[(this_site_id, this_id)]
+            elif self.pool is not None:
+                # a worker only needs the old manifest entries of its own manual
+                previous = dict((this_id, entry) for this_id, entry in reusable.items() if entry.get('manual') == this_manual_id)
+                manual_jobs.append(self.pool.submit(export_manual_unit, this_site_id, site_folder, manual, previous, manual_targets))
+            else:
+                manual_jobs.append(run_now(self.export_manual, this_site_id, site_folder, manual, reusable, manual_targets))
+
+        return {'id': this_site_id, 'folder': site_folder, 'old_manifest': old_manifest, 'manifest': manifest, 'manual_jobs': manual_jobs}
+
+    # merge what the site's manuals wrote into its manifest once they're done
+    def finish_site(self, started_site):
+        this_site_id = started_site['id']
+        site_folder = started_site['folder']
+        old_manifest = started_site['old_manifest']
+        manifest = started_site['manifest']
+
+        for manual_job in started_site['manual_jobs']:
+            exported = manual_job.result()
+            self.metrics.merge(exported.get('metrics', []))
+            self.failures.extend(exported.get('failures', []))
+            if 'shard' in exported:
+                self.shard_sites[this_site_id]['manuals'][exported['manual']] = exported['shard']
+            for entry in exported['articles']:
+                self.index_article(site_folder, entry)
+            if self.incremental:
+                for entry in exported['articles']:
+                    manifest['articles'][_decode(entry['id'])] = entry
+                if self.is_manual_files:
+                    manifest['manuals'][exported['manual']] = {'files': exported['files']}
+
+        # only forget about articles and manuals this run could have seen
+        start = time.perf_counter()
+        if self.incremental:
+            for this_id, entry in old_manifest['articles'].items():
+                if this_id not in manifest['articles'] and (len(self.article_ids) > 0 or not selected(self.manual_ids, entry.get('manual'))):
+                    manifest['articles'][this_id] = entry
+            for this_id, entry in old_manifest['manuals'].items():
+                if this_id not in manifest['manuals'] and (len(self.article_ids) > 0 or len(self.manual_ids) > 0):
+                    manifest['manuals'][this_id] = entry
+            with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'manifest')):
+                removed = prune_manifest(site_folder, old_manifest, manifest)
+                write_manifest(site_folder, manifest)
+            # articles an earlier run exported can be linked to as well
+            for entry in manifest['articles'].values():
+                self.index_article(site_folder, entry)
+            for path in removed:
+                self.emit('removed', ">> Removing " + _print(path), site=this_site_id, path=path)
+
+        self.journal.record({'type': 'site', 'site': this_site_id, 'folder': os.path.relpath(site_folder, self.work_folder), 'shard': self.shard_sites.get(this_site_id)})
+        self.metrics.add('phase_seconds_total', time.perf_counter() - start, ('phase', 'manifests'))
+
+    def export_sites(self):
+        if len(self.site_ids) > 0:
+            # the sites were picked with -s, so they're looked up directly
+            # (manuals and all) instead of listing every site
+            self.emit('sites', "> Pulling sites: " + ', '.join(self.site_ids), ids=self.site_ids)
+            sites = {'sites': [{'id': this_site_id} if this_site_id in self.journal.sites else self.screensteps('sites/' + this_site_id)['site'] for this_site_id in self.site_ids]}
+        else:
+            # grab all sites for that user information
+            self.emit('sites', "> Pulling sites")
+            sites = self.screensteps('sites') # grab sites
+            self.emit('sites', "> " + _print(str(sites)), sites=sites['sites'])
+
+        # loop through sites. with -P every site's manuals are queued up
+        # before any site is finished, so all the processes have work
+        started_sites = []
+        for site in sites['sites']:
+            this_site_id = _decode(site['id'])
+            if this_site_id in self.journal.sites:
+                if self.shard_count > 0:
+                    self.shard_sites[this_site_id] = self.journal.sites[this_site_id]['shard']
+                for (entry_site_id, this_id), entry in self.journal.articles.items():
+                    if entry_site_id == this_site_id:
+                        self.index_article(os.path.join(self.work_folder, self.journal.sites[this_site_id]['folder']), entry)
+                self.emit('site', ">> Already exported site: " + _print(site.get('title', this_site_id)), id=this_site_id, title=site.get('title', this_site_id), status='resumed')
+            elif selected(self.site_ids, this_site_id): # only action a site if site_id isn't set, or is a match
+                started_sites.append(self.start_site(site))
+                if self.pool is None:
+                    self.finish_site(started_sites.pop())
+        for started_site in started_sites:
+            self.finish_site(started_site)
+
+        # links to articles that were exported after the articles linking to them
+        self.rewrite_pending_links([(site_folder, entry, self.work_folder) for site_folder, entry in list(self.article_index.values())])
+
+        # a shard leaves what the merge needs next to its output
+        if self.shard_count > 0:
+            write_file(self.work_folder, shard_file_name, json.dumps({'shard': [self.shard_index, self.shard_count], 'signature': self.export_signature, 'sites': self.shard_sites}, sort_keys=True))
+
+    # put the output folders of all the shards of an export together, and write
+    # the TOC files from their articles
+    def merge_shards(self):
+        shards = []
+        for folder in self.merge_folders:
+            shard = json.loads(read_file(os.path.join(folder, shard_file_name)))
+            if shard['signature'] != self.export_signature:
+                raise ExportError("Error: " + folder + " was exported with other templates or settings (-t, -i, -S) than this merge.")
+            shard['folder'] = folder
+            shards.append(shard)
+        shard_count = shards[0]['shard'][1]
+        if sorted(shard['shard'][0] for shard in shards) != list(range(1, shard_count + 1)) or any(shard['shard'][1] != shard_count for shard in shards):
+            raise ExportError("Error: -g needs the output of each of the " + _decode(shard_count) + " shards exactly once.")
+        self.emit('info', "Info: Merging " + _decode(shard_count) + " shards.")
+
+        # every shard walked every manual, so any of them has its chapters and
+        # the order of their articles. Each article is in one shard
+        manuals = {}
+        linked = []
+        for shard in shards:
+            for this_site_id, site in shard['sites'].items():
+                site_folder = os.path.join(self.work_folder, site['folder'])
+                for this_manual_id, manual in site['manuals'].items():
+                    merged = manuals.setdefault((this_site_id, this_manual_id), {'folder': site['folder'], 'manual': manual, 'entries': {}})
+                    merged['entries'].update((_decode(entry['id']), entry) for entry in manual['articles'])
+                    for entry in manual['articles']:
+                        self.index_article(site_folder, entry)
+                        linked.append((site_folder, entry, shard['folder']))
+
+        # the shards' files don't overlap, except for the template layout.
+        # Articles with links to other shards' articles are written again
+        # instead of linked
+        skipped = (shard_file_name, journal_file_name, manifest_file_name, report_file_name, prometheus_file_name)
+        rewritten = set(os.path.normpath(path) for path, source_path in self.pending_link_files(linked))
+        for shard in shards:
+            for directory, folders, files in os.walk(shard['folder']):
+                folders[:] = sorted(folder for folder in folders if folder != media_store_folder)
+                target = os.path.normpath(os.path.join(self.work_folder, os.path.relpath(directory, shard['folder'])))
+                self.output.make_dir(target)
+                with self.metrics.timer('filesystem_write_seconds_total', ('operation', 'merge')):
+                    for name in sorted(files):
+                        if name not in skipped and not name.endswith('.part') and os.path.join(target, name) not in rewritten:
+                            self.output.link_file(os.path.join(directory, name), os.path.join(target, name))
+        self.rewrite_pending_links(linked)
+
+        for (this_site_id, this_manual_id), merged in sorted(manuals.items()):
+            start = time.perf_counter()
+            site_folder = os.path.join(self.work_folder, merged['folder'])
+            chapters = merged['manual']['chapters']
+            this_manual_identifier = merged['manual']['identifier']
+            self.emit('manual', ">>> Merging manual: " + _print(chapters['manual']['title']), site=this_site_id, id=this_manual_id, title=chapters['manual']['title'], status='merging')
+            toc_writers = self.open_tocs(site_folder, this_manual_identifier, chapters)
+            entries = []
+            try:
+                for chapter in chapters['manual']['chapters']:
+                    chapter['articles'] = []
+                    article_ids = merged['manual']['order'].get(_decode(chapter['id']), [])
+                    article_jobs = [run_now(dict, merged['entries'][this_id]) for this_id in article_ids if this_id in merged['entries']]
+                    self.finish_chapter((chapter, article_jobs), this_manual_id, toc_writers, entries)
+                self.close_tocs(site_folder, this_manual_identifier, chapters, toc_writers, entries)
+            finally:
+                for toc_writer in toc_writers.values():
+                    toc_writer.abort()
+            self.metrics.add('articles_skipped_total', len(entries), ('reason', 'merged'))
+            self.metrics.add('phase_seconds_total', time.perf_counter() - start, ('phase', 'manuals'))
+
+    # walk the selection without exporting it, and write what it takes to the
+    # plan file: the counts, the requests, the media and an estimate of how
+    # long it would take at the rate requests were answered while planning.
+    # The plan keeps the settings and the site, manual and chapter responses
+    # (the articles of each chapter listed in its manual), so -e can run it.
+    def make_plan(self):
+        start = time.perf_counter()
+        counts = {'sites': 0, 'manuals': 0, 'chapters': 0, 'articles': 0}
+        responses = {}
+        def fetch(endpoint):
+            responses[endpoint] = self.screensteps(endpoint)
+            return responses[endpoint]
+
+        if len(self.site_ids) > 0:
+            sites = [fetch('sites/' + this_site_id)['site'] for this_site_id in self.site_ids]
+        else:
+            sites = fetch('sites')['sites']
+        article_jobs = []
+        listings = 0 # chapter requests
+        for site in sites:
+            this_site_id = _decode(site['id'])
+            if not selected(self.site_ids, this_site_id):
+                continue
+            counts['sites'] += 1
+            self.emit('site', ">> Planning site: " + _print(site['title']), id=this_site_id, title=site['title'], status='planning')
+            manuals = site['manuals'] if 'manuals' in site else fetch('sites/' + this_site_id)['site']['manuals']
+
+            # like an export, articles picked with -a in a single site are
+            # looked up directly
+            targets = None
+            if len(self.article_ids) > 0 and len(self.site_ids) == 1:
+                targets = [self.screensteps('sites/' + this_site_id + '/articles/' + this_article_id) for this_article_id in self.article_ids]
+                article_jobs.extend(run_now(dict, target) for target in targets)
+            for manual in manuals:
                 this_manual_id = _decode(manual['id'])
-                if (manual_id == this_manual_id) or (manual_id == ''): # only action a manual if manual isn't set, or is a match
-                    print(">>> Processing manual: " + _print(manual['title']))
-                    # print(">>> " + _print(manual))
-
-                    if object_identifier == "title_id":
-                        this_manual_identifier = prepare_for_filename(manual["title"]) + " [" + this_manual_id + "]"
-                    elif object_identifier == "title":
-                        this_manual_identifier = prepare_for_filename(manual["title"])
-                    else:
-                        this_manual_identifier = this_manual_id
-
-                    chapters = screensteps('sites/' + this_site_id + '/manuals/' + this_manual_id) # grab chapters
-
-                    # pre-chapter replaces on _decode(manual_files_ref[path][0])
-                    if is_manual_files: # are there templates?
-                        manual_files_temp = {}
-                        for path, details in manual_files.items():
-                            manual_files_temp[path] = []
-                            manual_files_temp[path].append(_decode(manual_files_ref[path][0]).replace('{{title}}', chapters['manual']['title']))
-
-                    # loop through chapters
-                    for chapter in chapters['manual']['chapters']:
-                        this_chapter_id = _decode(chapter['id'])
-                        print(">>>> Processing chapter: " + _print(chapter['title']))
-                        # print(">>>> " + _print(chapter))
-
-                        chapter['articles'] = []
-
-                        # pre-article replaces on _decode(manual_files_ref[path][1])
-                        if is_manual_files: # are there templates?
-                            for path, details in manual_files.items():
-                                manual_files_temp[path].append(_decode(manual_files_ref[path][1]).replace('{{title}}', chapter['title']))
-
-                        articles = screensteps('sites/' + this_site_id + '/chapters/' + this_chapter_id) # grab articles
-
-                        # loop through articles
-                        for article in articles['chapter']['articles']:
-                            this_article_id = _decode(article['id'])
-                            if (article_id == this_article_id) or (article_id == ''): # only action an article if article_id isn't set, or is a match
-                                print(">>>>> Processing article: " + _print(article['title']))
-                                # print(">>>>> " + _print(article))
-
-                                this_article = screensteps('sites/' + this_site_id + '/articles/' + this_article_id) # grab ind article
-
-                                this_article_title = this_article['article']['title']
-
-                                if object_identifier == "title_id":
-                                    this_article_identifier = prepare_for_filename(this_article_title) + " [" + this_article_id + "]"
-                                elif object_identifier == "title":
-                                    this_article_identifier = prepare_for_filename(this_article_title)
-                                else:
-                                    this_article_identifier = this_article_id
-
-                                if is_article_folder:
-                                    article_folder = os.path.join(site_folder, find_relative_path(at_article_folder,template_folder), this_article_identifier)
-                                    copy_and_overwrite(at_article_folder, article_folder)
-                                else:
-                                    # write html to a file if no templates
-                                    article_folder = site_folder
-
-                                # Add to list of article ids and titles
-                                chapter["articles"].append( {'id': this_article['article']['id'], 'title': this_article_identifier} )
-
-                                article_html = this_article['article']['html_body']
-
-                                # loop through attached files
-                                this_articles_files = []
-                                for content_block in this_article['article']['content_blocks']:
-                                    if 'url' in content_block:
-
-                                        # what type of file is it?
-                                        download_ext = os.path.splitext(urlparse(content_block['url']).path)[1]
-                                        if content_block['type'] == 'AttachmentContent': # attachment
-                                            if is_attach_folder:
-                                                files_folder = os.path.join(site_folder,at_attach_folder)
-                                                short_files_folder = at_attach_folder
-                                                if '@article' in files_folder:
-                                                    files_folder = files_folder.replace("@article", this_article_identifier)
-                                                    short_files_folder = short_files_folder.replace("@article", this_article_identifier)
-                                            else:
-                                                files_folder = os.path.join(article_folder, 'attachments')
-                                                short_files_folder = 'attachments'
-                                                make_dir(files_folder)
-                                        else: # image
-                                            if is_image_folder:
-                                                files_folder = os.path.join(site_folder,at_images_folder)
-                                                short_files_folder = at_images_folder
-                                                if '@article' in files_folder:
-                                                    files_folder = files_folder.replace("@article", this_article_identifier)
-                                                    short_files_folder = short_files_folder.replace("@article", this_article_identifier)
-                                            else:
-                                                files_folder = os.path.join(article_folder, 'images')
-                                                short_files_folder = 'images'
-                                                make_dir(files_folder)
-
-                                        print(">>>>>> Processing " + _print(content_block['type']) + ": " + _print(content_block['url']))
-                                        new_file_path = download_file(files_folder,content_block['url'])
-                                        this_articles_files.append([ _decode(content_block['url']), os.path.join(short_files_folder,new_file_path)])
-
-                                article_files_paths = []
-                                if template_specified:
-                                    # step through each file that starts with "@article"
-                                    for path, temp_html in article_files.items():
-
-                                        back_dir = ''
-                                        article_relative_path = find_relative_path(path,template_folder)
-                                        temp_filename = this_article_identifier + os.path.splitext(path)[1]
-                                        if article_relative_path != '':
-                                            article_relative_path = article_relative_path.replace("@article", this_article_identifier)
-                                            temp_filename = os.path.join(article_relative_path,temp_filename)
-                                            back_dir = '../' * len(split_path(article_relative_path))
-
-                                        # find and replace {{html}}
-                                        temp_towrite = temp_html.replace("""{{html}}""",article_html)
-                                        temp_towrite = temp_towrite.replace("""{{json}}""",json.dumps(this_article, sort_keys=True, indent=2, separators=(',', ': ')))
-
-                                        # find and replace all the other handlebars specified
-                                        for article_handlebar in article_handlebars:
-                                            if article_handlebar != "link":
-                                                temp_towrite = temp_towrite.replace(("{{" + _decode(article_handlebar) + "}}"), _decode(this_article['article'][article_handlebar]) )
-
-                                        for this_articles_file in this_articles_files:
-                                            # take off any query params
-                                            image_url = this_articles_file[0].split("?", 1)[0]
-                                            temp_towrite = temp_towrite.replace(image_url,(back_dir + this_articles_file[1].replace("\\", "/"))) # Fix windows paths
-                                            # workaround: perform replace on thumbnail images
-                                            thumbnail_url = image_url.replace("/original/", "/medium/")
-                                            temp_towrite = temp_towrite.replace(thumbnail_url,(back_dir + this_articles_file[1].replace("\\", "/"))) # Fix windows paths
-
-                                        # write file
-                                        write_file(site_folder, temp_filename, temp_towrite)
-                                        article_files_paths.append(temp_filename)
-                                else:
-                                    for this_articles_file in this_articles_files:
-                                        article_html = article_html.replace(this_articles_file[0],this_articles_file[1].replace("\\", "/")) # Fix windows paths
-                                    write_file(article_folder, (this_article_identifier + '.html'), article_html)
-                                    article_files_paths.append((this_article_identifier + '.html'))
-
-                                # article replaces on _decode(manual_files_ref[path][2])
-                                if is_manual_files: # are there templates?
-                                    article_handlebars.append("link")
-
-                                    for path, details in manual_files.items():
-                                        article_string = _decode(manual_files_ref[path][2])
-                                        for article_handlebar in article_handlebars:
-                                            if article_handlebar == "link":
-                                                try:
-                                                    same_ext_link = next(i for i in article_files_paths if os.path.splitext(i)[1] ==  os.path.splitext(path)[1])
-                                                except:
-                                                    print("Error: We didn't find a file extension match for the article from the TOC with: " + os.path.splitext(path)[1])
-                                                    sys.exit()
-                                                article_string = article_string.replace(("{{" + _decode(article_handlebar) + "}}"), same_ext_link)
-                                            else:
-                                                article_string = article_string.replace(("{{" + _decode(article_handlebar) + "}}"),_decode(this_article['article'][article_handlebar]))
-                                        manual_files_temp[path].append(article_string)
-
-                        # post-article replaces on _decode(manual_files_ref[path][3])
-                        if is_manual_files: # are there templates?
-                            for path, details in manual_files.items():
-                                manual_files_temp[path].append(_decode(manual_files_ref[path][3]).replace('{{title}}',_decode(chapter['title'])))
-
-                    # post-chapter replaces on _decode(manual_files_ref[path][4])
-                    if is_manual_files: # are there templates?
-                        for path, details in manual_files.items():
-                            manual_files_temp[path].append(_decode(manual_files_ref[path][4]).replace('{{title}}',chapters['manual']['title']))
-
-                            manual_relative_path = find_relative_path(path,template_folder)
-                            if manual_relative_path == '':
-                                manual_relative_path = site_folder
-                            else:
-                                manual_relative_path = os.path.join(site_folder,manual_relative_path)
-
-                            # dump files
-                            if manual_file_name != "":
-                                temp_filename = manual_file_name + os.path.splitext(path)[1]
-                            else:
-                                temp_filename = this_manual_identifier + os.path.splitext(path)[1]
-                            temp_file_contents = (''.join(manual_files_temp[path]) + add_end_manual_file)
-                            temp_file_contents = temp_file_contents.replace("""{{json}}""", json.dumps(chapters, sort_keys=True, indent=2, separators=(',', ': ')))
-                            write_file(manual_relative_path, temp_filename, temp_file_contents)
-
-            # clean up the "@" files that we copied over for each site
-            if template_specified:
+                manual_targets = [target for target in targets or [] if _decode(target['article']['manual_id']) == this_manual_id]
+                if not selected(self.manual_ids, this_manual_id) or (targets is not None and len(manual_targets) == 0):
+                    continue
+                counts['manuals'] += 1
+                chapters = fetch('sites/' + this_site_id + '/manuals/' + this_manual_id)
+                counts['chapters'] += len(chapters['manual']['chapters'])
+                if targets is not None:
+                    counts['articles'] += len(manual_targets)
+                    continue
+
+                # the listings are fetched -j at a time and kept in the manual
+                listing_jobs = []
+                for chapter in chapters['manual']['chapters']:
+                    if not isinstance(chapter.get('articles'), list):
+                        listings += 1
+                    listing_jobs.append(self.list_articles(this_site_id, chapter, None))
+                for chapter, listing_job in zip(chapters['manual']['chapters'], listing_jobs):
+                    chapter['articles'] = listing_job.result()
+                    for article in chapter['articles']:
+                        this_article_id = _decode(article['id'])
+                        if selected(self.article_ids, this_article_id) and self.in_shard(this_site_id, this_article_id):
+                            counts['articles'] += 1
+                            article_jobs.append(self.submit(self.screensteps, 'sites/' + this_site_id + '/articles/' + this_article_id))
+
+        # the media of every article, once per url like the media store
+        media = collections.OrderedDict()
+        references = 0
+        for article_job in article_jobs:
+            for content_block in article_job.result()['article']['content_blocks']:
+                if 'url' in content_block:
+                    references += 1
+                    media.setdefault(content_block['url'].split('?', 1)[0], content_block['url'])
+        sizes = []
+        if self.head and self.snapshot is None:
+            self.emit('info', "Info: Asking for the size of " + _decode(len(media)) + " media files.")
+            # a server that won't answer HEAD for a file only leaves its size unknown
+            def media_size(url):
                 try:
-                    remove_found_files(find_file(article_file_indicator,site_folder))
-                    remove_found_files(find_file(manual_file_indicator,site_folder))
-                    remove_found_files(find_file(image_folder_indicator,site_folder))
-                    remove_found_files(find_file(attach_folder_indicator,site_folder))
-                    remove_directories(find_dirs("@article", site_folder))
-                except:
-                    print("We had trouble deleting the copied template files.  You can ignore any extra files.")
+                    return int(self.requester.get(url, lambda r: r.headers['Content-Length'], method='HEAD'))
+                except (ExportError, KeyError, ValueError):
+                    self.emit('warning', "Warn: The server gave no size for " + url, url=url)
+                    return None
+            size_jobs = [self.submit(media_size, url) for url in media.values()]
+            sizes = [job.result() for job in size_jobs if job.result() is not None]
+
+        seconds = time.perf_counter() - start
+        made = self.metrics.total('api_requests_total') + len(sizes)
+        per_second = made / seconds if seconds > 0 else 0
+        requests_with_plan = len(article_jobs) + len(media)
+        plan = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'settings': dict((name, self.output_setting if name == 'output_folder' else getattr(self, name)) for name in ExportConfig.defaults if name not in ('user_id', 'api_token', 'plan', 'head', 'execute')),
+            'counts': counts,
+            'requests': {
+                'api': len(responses) + listings + len(article_jobs),
+                'api_with_plan': len(article_jobs),
+                'media': len(media)},
+            'media': {
+                'references': references,
+                'files': len(media),
+                'bytes': sum(sizes) if self.head else None,
+                'unknown_sizes': len(media) - len(sizes) if self.head else None},
+            'requests_per_second': round(per_second, 3),
+            'estimated_seconds': round(requests_with_plan / per_second, 1) if per_second > 0 else None,
+            'responses': responses}
+        write_file(os.path.dirname(os.path.abspath(self.plan)), os.path.basename(self.plan), json.dumps(plan, sort_keys=True, indent=2, separators=(',', ': ')))
+
+        self.emit('info', "Info: Planned " + ', '.join(_decode(counts[kind]) + " " + kind for kind in ('sites', 'manuals', 'chapters', 'articles')) + ".")
+        self.emit('info', "Info: The export needs " + _decode(plan['requests']['api']) + " API requests, or " + _decode(plan['requests']['api_with_plan']) + " when run with -e, and " + _decode(len(media)) + " media downloads for " + _decode(references) + " references" + (" (" + _decode(round(sum(sizes) / 1048576.0, 1)) + " MB)" if self.head else "") + ".")
+        if plan['estimated_seconds'] is not None:
+            self.emit('info', "Info: At the " + _decode(round(per_second, 1)) + " requests per second answered while planning, running it would take about " + _decode(plan['estimated_seconds']) + " seconds.")
+        self.emit('info', "Info: Plan written to " + self.plan)
+
+    # returns the run report. Anything that stops the export is raised as an
+    # ExportError once the report is written
+    def run(self, session=None):
+        finished = False
+        started = time.time()
+        try:
+            self.open(session=session)
+            if self.plan != '':
+                self.make_plan()
+            elif len(self.merge_folders) > 0:
+                self.merge_shards()
+            else:
+                self.export_sites()
+            finished = True
+        except ExportError as e:
+            e.resumable = self.archive is None and len(self.merge_folders) == 0 and self.plan == ''
+            raise
+        except (requests.exceptions.RequestException, OSError, concurrent.futures.BrokenExecutor) as e:
+            raise ExportError("Error: " + _decode(e), resumable=self.archive is None and len(self.merge_folders) == 0 and self.plan == '') from e
+        finally:
+            self.close(finished)
+            report = self.write_reports(finished, started, time.time() - started)
+
+        revalidated = self.metrics.total('media_revalidated_total')
+        if self.plan == '':
+            self.emit('info', "Info: Downloaded " + _decode(self.metrics.total('media_downloads_total')) + " media files" + (" (" + _decode(revalidated) + " more were unchanged since the last run)" if revalidated > 0 else "") + " for " + _decode(self.metrics.total('media_placed_total')) + " references.")
+        saved = self.metrics.total('api_requests_saved_total')
+        self.emit('info', "Info: Made " + _decode(self.metrics.total('api_requests_total')) + " API requests" + (" (" + _decode(saved) + " more were answered by the manual or the plan)" if saved > 0 else "") + ". " + _decode(self.metrics.total('api_rate_limited_total')) + " were rate limited, pausing the export for " + _decode(round(float(self.metrics.total('rate_limit_paused_seconds_total')), 3)) + " seconds.")
+        if len(self.failures) > 0:
+            self.emit('warning', "Warn: " + _decode(len(self.failures)) + " articles failed and were skipped: " + ', '.join(failure['id'] for failure in self.failures))
+        if self.archive is not None and self.plan == '':
+            self.emit('info', "Info: Export written to " + self.output_folder)
+        if self.report_folder != '':
+            self.emit('finished', "Info: Run report written to " + os.path.join(self.report_folder, report_file_name), report=report)
+        else:
+            self.emit('finished', "Info: Planning finished." if self.plan != '' else "Info: Export finished.", report=report)
+        return report
+
+class Exporter:
+    # Runs exports from Python, e.g. many of them in one long-running service:
+    #
+    #   with Exporter() as exporter:
+    #       for event in exporter.events(ExportConfig(site_name='acme', user_id='me', api_token='...')):
+    #           print(event['message'])
+    #
+    # All the exports share the exporter's HTTP session, or the one it's given,
+    # so connections are kept alive from one export to the next.
+    def __init__(self, session=None):
+        self.session = session
+        self.own_session = session is None
+        self.pool_size = 0
+        self.lock = threading.Lock()
+
+    def session_for(self, jobs):
+        with self.lock:
+            if self.own_session and jobs > self.pool_size:
+                # enough keep-alive connections for the most jobs asked for so far
+                self.session = new_session(jobs, self.session)
+                self.pool_size = jobs
+            return self.session
+
+    # run one export, calling on_event with each of its events. Returns the
+    # run report, or raises ExportError
+    def export(self, config, on_event=None):
+        run = ExportRun(config, on_event)
+        return run.run(self.session_for(run.jobs))
+
+    # export() on a thread of its own, yielding the events as they come. The
+    # last one is 'finished', with the run report
+    def events(self, config):
+        events = queue.Queue()
+        failure = []
+        def export():
+            try:
+                self.export(config, events.put)
+            except BaseException as e:
+                failure.append(e)
+            finally:
+                events.put(None)
+        thread = threading.Thread(target=export, daemon=True)
+        thread.start()
+        for event in iter(events.get, None):
+            yield event
+        thread.join()
+        if len(failure) > 0:
+            raise failure[0]
+
+    def close(self):
+        if self.own_session and self.session is not None:
+            self.session.close()
+            self.session = None
+            self.pool_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# With -P each worker process gets its own copy of the exporter, opened once
+# when the process starts, and exports whole manuals with it.
+worker_exporter = None
+
+def start_worker(exporter, event_queue, folder_locks):
+    global worker_exporter
+    if event_queue is not None:
+        exporter.on_event = event_queue.put
+    exporter.folder_locks = folder_locks
+    exporter.open(worker=True)
+    worker_exporter = exporter
+
+def export_manual_unit(this_site_id, site_folder, manual, reusable, targets):
+    exported = worker_exporter.export_manual(this_site_id, site_folder, manual, reusable, targets)
+    exported['metrics'] = worker_exporter.metrics.take()
+    exported['failures'] = worker_exporter.failures
+    worker_exporter.failures = []
+    return exported
+
+def main(argv):
+    config = parse_options(argv)
+    try:
+        with Exporter() as exporter:
+            report = exporter.export(config, ProgressLog(config.verbose))
+    except ExportError as e:
+        print(_decode(e))
+        if e.resumable:
+            print("Info: Run again with -R to carry on from where this export stopped.")
+        sys.exit(2)
+    if len(report['failed_articles']) > 0:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
+    # a worker process of -P in a pyinstaller build starts here too, and is
+    # taken off to the worker instead of running main()
+    multiprocessing.freeze_support()
     main(sys.argv[1:])
@@ -0,0 +1,316 @@
+# Exports a small synthetic account from the benchmark's mock server.
+# Run with: python -m unittest test_ss_exporter
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+import requests
+
+import ss_benchmark
+from ss_exporter import Exporter, ExportConfig, ExportError, MediaStore, Requester, RequestScheduler, Journal, write_data
+
+class ExportTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.account = ss_benchmark.SyntheticAccount(2, 1, 2, 2, 1, 1)
+        cls.server = ss_benchmark.MockServer(cls.account)
+        cls.original_request = requests.Session.request
+        ss_benchmark.redirect_requests(cls.server.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        requests.Session.request = cls.original_request
+        cls.server.close()
+
+    def setUp(self):
+        self.server.failing = {}
+        self.folder = tempfile.mkdtemp(prefix='ss_exporter_test_')
+        self.output_folder = os.path.join(self.folder, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def config(self, **settings):
+        settings.setdefault('template_folder', 'samples/manual_w_images_folder')
+        return ExportConfig(site_name='test', user_id='test', api_token='test', output_folder=self.output_folder, **settings)
+
+    def export(self, **settings):
+        with Exporter() as exporter:
+            return exporter.export(self.config(**settings))
+
+    def tree(self, folder):
+        # path -> contents of every file an export wrote, leaving out its own dot files
+        files = {}
+        for directory, folders, names in os.walk(folder):
+            folders[:] = [name for name in folders if not name.startswith('.')]
+            for name in names:
+                if not name.startswith('.'):
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        files[os.path.relpath(os.path.join(directory, name), folder)] = f.read()
+        return files
+
+class ResumeTest(ExportTestCase):
+    def test_resume_after_a_finished_site(self):
+        # the last article is in site 2, so site 1 is finished when it fails
+        last_article = self.account.article_count()
+        self.server.failing['/api/v2/sites/2/articles/%d' % last_article] = 404
+        with self.assertRaises(ExportError) as raised:
+            self.export()
+        self.assertTrue(raised.exception.resumable)
+
+        self.server.failing = {}
+        events = []
+        with Exporter() as exporter:
+            report = exporter.export(self.config(resume=True), on_event=events.append)
+        self.assertTrue(report['finished'])
+        self.assertIn('resumed', [event.get('status') for event in events if event['type'] == 'site'])
+        self.assertTrue(os.path.exists(os.path.join(self.output_folder, '1', 'articles', '1.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_folder, '2', 'articles', '%d.html' % last_article)))
+
+class JobsTest(ExportTestCase):
+    def test_same_output_as_a_serial_run(self):
+        self.export()
+        serial = self.tree(self.output_folder)
+
+        # every third article is answered late, so the jobs finish out of order
+        article = self.account.article
+        def slow_article(article_id, media_url):
+            if article_id % 3 == 1:
+                time.sleep(0.2)
+            return article(article_id, media_url)
+        self.output_folder = os.path.join(self.folder, 'jobs')
+        with mock.patch.object(self.account, 'article', slow_article):
+            self.export(jobs=8)
+        self.assertEqual(serial, self.tree(self.output_folder))
+
+    def test_failed_article_stops_the_export_cleanly(self):
+        # the other jobs are still downloading media when the export stops
+        self.server.failing['/api/v2/sites/1/articles/1'] = 404
+        report_folder = os.path.join(self.folder, 'report')
+        for attempt in range(5):
+            with self.assertRaises(ExportError) as raised:
+                self.export(jobs=8, report_folder=report_folder)
+            self.assertTrue(raised.exception.resumable)
+            self.assertTrue(os.path.exists(os.path.join(report_folder, 'ss_exporter_report.json')))
+
+    def test_articles_with_the_same_title(self):
+        # with -i title every article goes to the same folder, one at a time
+        article = self.account.article
+        def overview(article_id, media_url):
+            body = article(article_id, media_url)
+            body['article']['title'] = 'Overview'
+            return body
+        with mock.patch.object(self.account, 'article', overview):
+            for attempt in range(5):
+                self.export(jobs=8, object_identifier='title', template_folder='samples/manual_w_single_article_folder')
+        self.assertTrue(os.path.isdir(os.path.join(self.output_folder, 'Site 1', 'articles', 'Overview')))
+
+class IncrementalTest(ExportTestCase):
+    def test_deleted_article_is_removed(self):
+        self.export(incremental=True)
+        self.assertTrue(os.path.exists(os.path.join(self.output_folder, '1', 'articles', '2.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.output_folder, '1', 'images', '2')))
+        unchanged_path = os.path.join(self.output_folder, '1', 'articles', '1.html')
+        unchanged_mtime = os.stat(unchanged_path).st_mtime_ns
+
+        listing = self.account.chapter_articles
+        def without_article_2(chapter_id):
+            return [entry for entry in listing(chapter_id) if entry['id'] != 2]
+        with mock.patch.object(self.account, 'chapter_articles', without_article_2):
+            self.export(incremental=True)
+
+        self.assertFalse(os.path.exists(os.path.join(self.output_folder, '1', 'articles', '2.html')))
+        self.assertFalse(os.path.exists(os.path.join(self.output_folder, '1', 'images', '2')))
+        self.assertEqual(unchanged_mtime, os.stat(unchanged_path).st_mtime_ns)
+        with open(os.path.join(self.output_folder, '1', '1.html')) as f:
+            toc = f.read()
+        self.assertIn('articles/1.html', toc)
+        self.assertNotIn('articles/2.html', toc)
+
+class ShardTest(ExportTestCase):
+    def test_merged_shards_match_an_unsharded_export(self):
+        self.export()
+        unsharded = self.tree(self.output_folder)
+
+        shard_folders = []
+        for shard in ('1/2', '2/2'):
+            self.output_folder = os.path.join(self.folder, 'shard' + shard[0])
+            shard_folders.append(self.output_folder)
+            self.export(shard=shard)
+        self.assertNotEqual([], [path for path in self.tree(shard_folders[0]) if path.endswith('.html') and '/articles/' in path])
+        self.output_folder = os.path.join(self.folder, 'merged')
+        self.export(merge=','.join(shard_folders))
+        self.assertEqual(unsharded, self.tree(self.output_folder))
+
+class OutputFolderTest(ExportTestCase):
+    def test_only_the_export_is_left_in_it(self):
+        self.export()
+        self.assertFalse(os.path.exists(os.path.join(self.output_folder, '.ss_media')))
+        self.assertFalse(os.path.exists(os.path.join(self.output_folder, 'ss_exporter_report.json')))
+        self.export(incremental=True)
+        self.assertTrue(os.path.exists(os.path.join(self.output_folder, '.ss_media', 'index.jsonl')))
+
+class SkipFailedTest(ExportTestCase):
+    def test_incremental_keeps_an_edited_article_whose_media_fails(self):
+        self.export(incremental=True)
+        article_path = os.path.join(self.output_folder, '1', 'articles', '1.html')
+        with open(article_path) as f:
+            exported = f.read()
+
+        # article 1 is edited, and one of its images can't be downloaded
+        listing, article = self.account.chapter_articles, self.account.article
+        def edited_listing(chapter_id):
+            return [dict(entry, last_edited_at='2025-01-01T00:00:00Z') if entry['id'] == 1 else entry for entry in listing(chapter_id)]
+        def edited_article(article_id, media_url):
+            body = article(article_id, media_url)
+            if article_id == 1:
+                body['article']['last_edited_at'] = '2025-01-01T00:00:00Z'
+            return body
+        self.server.failing['/media/1/original/image_0.png'] = 404
+        with mock.patch.object(self.account, 'chapter_articles', edited_listing), mock.patch.object(self.account, 'article', edited_article):
+            report = self.export(incremental=True, skip_failed=True)
+
+        self.assertEqual(['1'], [failure['id'] for failure in report['failed_articles']])
+        with open(article_path) as f:
+            self.assertEqual(exported, f.read())
+        with open(os.path.join(self.output_folder, '1', '1.html')) as f:
+            self.assertIn('1.html', f.read()) # still in the TOC
+
+class ArchiveTest(ExportTestCase):
+    def test_links_to_later_articles_are_swapped(self):
+        # article 1 links to article 2, exported after it, and to one that isn't exported
+        article = self.account.article
+        def linking_article(article_id, media_url):
+            body = article(article_id, media_url)
+            if article_id == 1:
+                body['article']['html_body'] += '<a href="https://test.screenstepslive.com/a/2">2</a><a href="https://test.screenstepslive.com/a/999">999</a>'
+            return body
+        self.output_folder += '.zip'
+        with mock.patch.object(self.account, 'article', linking_article):
+            self.export()
+
+        with zipfile.ZipFile(self.output_folder) as archive:
+            html = archive.read('1/articles/1.html').decode('utf-8')
+        self.assertIn('href="2.html"', html)
+        self.assertIn('href="https://test.screenstepslive.com/a/999"', html)
+
+    def test_failed_setup_cleans_up(self):
+        # the snapshot can't be made under a file
+        not_a_folder = os.path.join(self.folder, 'file')
+        open(not_a_folder, 'w').close()
+        self.output_folder += '.zip'
+        with self.assertRaises(ExportError):
+            self.export(capture_folder=os.path.join(not_a_folder, 'snapshot'))
+        self.assertEqual(['file'], os.listdir(self.folder))
+
+class PrecompressTest(ExportTestCase):
+    def test_replay_leaves_the_snapshot_alone(self):
+        # every article gets a text attachment, which -Z compresses
+        article = self.account.article
+        def article_with_notes(article_id, media_url):
+            body = article(article_id, media_url)
+            body['article']['content_blocks'].append({'type': 'AttachmentContent', 'url': media_url + '%d/original/notes.txt' % article_id})
+            return body
+        snapshot_folder = os.path.join(self.folder, 'snapshot')
+        with mock.patch.object(self.account, 'article', article_with_notes):
+            self.export(capture_folder=snapshot_folder)
+        def listing():
+            return sorted(os.path.join(directory, name) for directory, folders, files in os.walk(snapshot_folder) for name in files)
+        snapshot_files = listing()
+
+        self.output_folder = os.path.join(self.folder, 'replayed')
+        self.export(replay_folder=snapshot_folder, precompress=True)
+        self.assertTrue(os.path.exists(os.path.join(self.output_folder, '1', 'images', '1', 'notes.txt.gz')))
+        self.assertEqual(snapshot_files, listing())
+
+class ScriptedSession:
+    # answers each request with the next (status, headers, body) and keeps
+    # the headers it was sent
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.sent.append(headers or {})
+        status, response_headers, body = self.responses.pop(0)
+        r = requests.Response()
+        r.status_code = status
+        r.headers.update(response_headers)
+        r.raw = io.BytesIO(body)
+        return r
+
+class MediaStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='ss_exporter_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_wrong_part_starts_over(self):
+        body = bytes(range(200))
+        session = ScriptedSession([
+            (200, {'Content-Length': '200', 'ETag': '"v1"'}, body[:100]), # cut off
+            (206, {'Content-Length': '100', 'Content-Range': 'bytes 0-99/200', 'ETag': '"v1"'}, body[:100]), # not where it stopped
+            (200, {'Content-Length': '200', 'ETag': '"v1"'}, body)])
+        store = MediaStore(os.path.join(self.folder, 'store'), Requester(session))
+        with mock.patch('time.sleep'):
+            stored_path = store.download('https://example.com/media/file.png')
+        with open(stored_path, 'rb') as f:
+            self.assertEqual(body, f.read())
+        self.assertNotIn('Range', session.sent[2])
+
+class RequestSchedulerTest(unittest.TestCase):
+    def test_burst_of_429s_pauses_for_retry_in(self):
+        scheduler = RequestScheduler(8, rate=50)
+        for throttled in range(20):
+            scheduler.acquire()
+            scheduler.throttle(0.1)
+        self.assertEqual(12.5, scheduler.rate)
+        start = time.monotonic()
+        scheduler.acquire()
+        self.assertLess(time.monotonic() - start, 0.2)
+
+class JournalTest(unittest.TestCase):
+    @unittest.skipUnless(os.name == 'posix', "folders are only synced on POSIX")
+    def test_written_folders_are_synced_once_before_the_record(self):
+        folder = tempfile.mkdtemp(prefix='ss_exporter_test_')
+        self.addCleanup(shutil.rmtree, folder)
+        journal = Journal(os.path.join(folder, '.ss_journal'), 'signature', False)
+        self.addCleanup(journal.close, True)
+        for name in ('1.html', '1.json', '1.txt'):
+            write_data(folder, name, b'article')
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync:
+            journal.record({'type': 'article'})
+        self.assertEqual(2, fsync.call_count) # the folder, then the journal
+
+class PlanTest(ExportTestCase):
+    def test_head_failure_leaves_a_size_unknown(self):
+        self.server.failing['/media/1/original/image_0.png'] = 403
+        plan_path = os.path.join(self.folder, 'plan.json')
+        self.export(plan=plan_path, head=True)
+        with open(plan_path) as f:
+            plan = json.load(f)
+        self.assertEqual(1, plan['media']['unknown_sizes'])
+        self.assertGreater(plan['media']['bytes'], 0)
+
+    def test_plan_writes_nothing_to_the_output_folder(self):
+        plan_path = os.path.join(self.folder, 'plan.json')
+        self.export(plan=plan_path)
+        self.assertFalse(os.path.exists(self.output_folder))
+        self.assertEqual(['plan.json'], os.listdir(self.folder))
+
+    def test_failed_plan_is_not_resumable(self):
+        self.server.failing['/api/v2/sites/2'] = 404
+        with self.assertRaises(ExportError) as raised:
+            self.export(plan=os.path.join(self.folder, 'plan.json'))
+        self.assertFalse(raised.exception.resumable)
+
+if __name__ == '__main__':
+    unittest.main()